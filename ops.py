@@ -11,9 +11,13 @@ __version__ = '0.4.6'
 import collections
 import copy
 import datetime
+import errno
+import fcntl
 import fnmatch
 import grp
+import hashlib
 import logging
+import mmap
 import numbers
 import os
 import pipes
@@ -21,11 +25,16 @@ import pwd
 import re
 import select
 import shutil
+import signal
 import stat as stat_
 import string
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+import uuid
 
 log = logging.getLogger('ops')
 type_ = type
@@ -46,6 +55,35 @@ else:
     basestring_type = basestring
     str_types += (unicode,)
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
 
 class Error(Exception):
     pass
@@ -157,14 +195,252 @@ def chown(path, user=None, group=None, recursive=False):
     return successful
 
 
-def cp(src_path, dst_path, follow_links=False, recursive=True):
+_FICLONE = 0x40049409
+
+# errors which mean a copy method isn't supported for these files
+_COPY_UNSUPPORTED = set([
+    errno.EBADF, errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP,
+    errno.EPERM, errno.EXDEV, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP),
+])
+
+_COPY_METHODS = ('reflink', 'copy_file_range', 'sendfile', 'read')
+
+
+def _copy_extents(src_fd, dst_fd, size, zeros=False, buffer_size=1024 * 1024):
+    """Copy the data extents of src_fd (found with SEEK_DATA and SEEK_HOLE)
+    to the empty dst_fd, so holes in src_fd stay holes. With zeros, or when
+    holes can't be found with SEEK_DATA, blocks of zeros in the data become
+    holes instead. The copy ends where reading src_fd does, as pseudo files
+    can be shorter than their size, or at its current size if it shrank."""
+    seek = hasattr(os, 'SEEK_DATA')
+    zeros = zeros or not seek
+    offset = 0
+    while offset < size:
+        start, end = offset, size
+        if seek:
+            try:
+                start = os.lseek(src_fd, offset, os.SEEK_DATA)
+                end = min(os.lseek(src_fd, start, os.SEEK_HOLE), size)
+            except OSError as error:
+                if error.errno == errno.ENXIO:
+                    break
+                if error.errno not in _COPY_UNSUPPORTED:
+                    raise
+                seek = False
+                zeros = True
+                start, end = offset, size
+        position = start
+        if not zeros and hasattr(os, 'copy_file_range'):
+            try:
+                while position < end:
+                    count = os.copy_file_range(src_fd, dst_fd, end - position, position, position)
+                    if not count:
+                        break
+                    position += count
+            except OSError as error:
+                if error.errno not in _COPY_UNSUPPORTED:
+                    raise
+        os.lseek(src_fd, position, os.SEEK_SET)
+        while position < end:
+            data = os.read(src_fd, min(64 * 1024 if zeros else buffer_size, end - position))
+            if not data:
+                break
+            if not zeros or data.count(b'\0') != len(data):
+                os.lseek(dst_fd, position, os.SEEK_SET)
+                while data:
+                    count = os.write(dst_fd, data)
+                    position += count
+                    data = data[count:]
+            else:
+                position += len(data)
+        if position < end:
+            size = position
+            break
+        offset = end
+    os.ftruncate(dst_fd, min(size, os.fstat(src_fd).st_size))
+
+
+def _copy_data(src_fd, dst_fd, size, methods=_COPY_METHODS, buffer_size=1024 * 1024, zeros=False):
+    """Copy the contents of src_fd to the empty dst_fd, using the first of
+    methods which works for them, and return its name.
+
+    A reflink shares the data blocks on copy on write filesystems, while
+    copy_file_range and sendfile copy in the kernel and extents only copies
+    the data of sparse files. Empty files (which includes most of /proc)
+    are always read, because their size can't be trusted.
+    """
+    offset = 0
+    chunk = max(min(size, 1 << 30), buffer_size)
+    for method in methods if size else ('read',):
+        try:
+            if method == 'reflink':
+                if not sys.platform.startswith('linux'):
+                    continue
+                fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+                return method
+            elif method == 'extents':
+                _copy_extents(src_fd, dst_fd, size, zeros=zeros, buffer_size=buffer_size)
+                return method
+            elif method == 'copy_file_range':
+                if not hasattr(os, 'copy_file_range'):
+                    continue
+                while True:
+                    count = os.copy_file_range(src_fd, dst_fd, chunk, offset, offset)
+                    if not count:
+                        return method
+                    offset += count
+            elif method == 'sendfile':
+                if not hasattr(os, 'sendfile'):
+                    continue
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                while True:
+                    count = os.sendfile(dst_fd, src_fd, offset, chunk)
+                    if not count:
+                        return method
+                    offset += count
+            else:
+                os.lseek(src_fd, offset, os.SEEK_SET)
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                while True:
+                    data = os.read(src_fd, buffer_size)
+                    if not data:
+                        return method
+                    while data:
+                        data = data[os.write(dst_fd, data):]
+        except (IOError, OSError) as error:
+            if error.errno not in _COPY_UNSUPPORTED:
+                raise
+    raise Error('no copy method: %s' % ', '.join(methods))
+
+
+def _copy_file(src_path, dst_path, methods=_COPY_METHODS, sparse='auto'):
+    """Copy the contents and metadata of a file, like shutil.copy2().
+
+    Files with holes are copied sparsely with sparse ``auto`` (a reflink
+    keeps them as well), with ``always`` blocks of zeros become holes in any
+    file and with ``never`` they're copied like any other file.
+    """
+    # O_NONBLOCK keeps open() from waiting for a writer on a FIFO
+    with os.fdopen(os.open(src_path, os.O_RDONLY | os.O_NONBLOCK), 'rb') as src:
+        st = os.fstat(src.fileno())
+        if not stat_.S_ISREG(st.st_mode):
+            raise IOError(errno.EINVAL, 'not a regular file', src_path)
+        with open(dst_path, 'wb') as dst:
+            if sparse == 'always':
+                methods = ('extents',)
+            # pseudo files (/sys) have no blocks at all, they aren't sparse
+            elif sparse == 'auto' and 0 < getattr(st, 'st_blocks', 0) * 512 < st.st_size:
+                methods = ('reflink', 'extents')
+            method = _copy_data(src.fileno(), dst.fileno(), st.st_size, methods=methods,
+                                zeros=sparse == 'always')
+    log.debug('cp: %s: %s => %s' % (method, src_path, dst_path))
+    shutil.copystat(src_path, dst_path)
+    return dst_path
+
+
+def _copy_tree(src_path, dst_path, symlinks=False, workers=1, sparse='auto'):
+    """Copy the directory src_path to dst_path, which must not exist, and
+    return a list of (src, dst, error) tuples for everything that failed.
+
+    The source is walked once, creating each directory as it's found. Files
+    are then copied by up to workers threads, followed by hard links to
+    files copied earlier and symlinks (which are followed unless symlinks is
+    true). Directory metadata is copied last, so their mtimes are kept.
+    """
+    os.makedirs(dst_path)
+    failures = []
+    dirs = [(src_path, dst_path)]
+    files = []
+    hardlinks = []
+    links = []
+    inodes = {}
+    index = 0
+    while index < len(dirs):
+        src_dir, dst_dir = dirs[index]
+        index += 1
+        try:
+            entries = sorted(_listdir(src_dir), key=lambda e: e.name)
+        except OSError as error:
+            failures.append((src_dir, dst_dir, error))
+            continue
+        for e in entries:
+            dst = os.path.join(dst_dir, e.name)
+            try:
+                link = e.is_symlink()
+                if link and symlinks:
+                    links.append((e.path, dst))
+                    continue
+                st = e.stat()
+                if stat_.S_ISDIR(st.st_mode):
+                    os.mkdir(dst)
+                    dirs.append((e.path, dst))
+                elif not stat_.S_ISREG(st.st_mode):
+                    failures.append((e.path, dst, Error('special file')))
+                elif st.st_nlink > 1 and not link and (st.st_dev, st.st_ino) in inodes:
+                    hardlinks.append((e.path, inodes[(st.st_dev, st.st_ino)], dst))
+                else:
+                    if st.st_nlink > 1 and not link:
+                        inodes[(st.st_dev, st.st_ino)] = dst
+                    files.append((e.path, dst))
+            except OSError as error:
+                failures.append((e.path, dst, error))
+
+    def copy(item):
+        try:
+            _copy_file(item[0], item[1], sparse=sparse)
+        except (IOError, OSError, Error) as error:
+            return item + (error,)
+
+    failures.extend([failure for failure in _map(copy, files, workers) if failure])
+    for src, target, dst in hardlinks:
+        try:
+            os.link(target, dst)
+        except OSError as error:
+            failures.append((src, dst, error))
+    for src, dst in links:
+        try:
+            os.symlink(os.readlink(src), dst)
+            if py3:
+                shutil.copystat(src, dst, follow_symlinks=False)
+        except OSError as error:
+            failures.append((src, dst, error))
+    for src, dst in reversed(dirs):
+        try:
+            shutil.copystat(src, dst)
+        except OSError as error:
+            failures.append((src, dst, error))
+    return failures
+
+
+def cp(src_path, dst_path, follow_links=False, recursive=True, workers=1, sparse='auto'):
     """Copy source to destination.
 
       >>> if cp('/tmp/one', '/tmp/two'):
       ...     print('OK')
       OK
+
+    File contents are copied with a reflink where the filesystem supports
+    them (btrfs, XFS), otherwise in the kernel with copy_file_range or
+    sendfile, before falling back to reading and writing. Permissions and
+    times are preserved like shutil.copy2(). With ``sparse`` set to
+    ``auto`` only the data of files with holes is copied (found with
+    SEEK_DATA and SEEK_HOLE, or by skipping blocks of zeros where those
+    aren't available), so the copy stays sparse, ``always`` also
+    turns blocks of zeros into holes and ``never`` copies files with holes
+    like any other file.
+
+    Directories are copied by walking them once and creating the directory
+    tree, then copying files with up to ``workers`` threads. Hard links
+    within the tree are kept. A failure to copy one entry doesn't stop the
+    others, each is logged and cp() returns False.
+
+      >>> cp('/srv/release', '/srv/staging', workers=16)
+      True
     """
     successful = False
+    if sparse not in ('auto', 'always', 'never'):
+        log.error('cp: invalid sparse: %s' % sparse)
+        return successful
     try:
         if follow_links and os.path.islink(src_path):
             src_path = os.path.realpath(src_path)
@@ -173,20 +449,192 @@ def cp(src_path, dst_path, follow_links=False, recursive=True):
         if os.path.isdir(src_path):
             if not recursive:
                 return successful
-            shutil.copytree(src_path, dst_path, symlinks=follow_links)
-            successful = True
+            failures = _copy_tree(src_path, dst_path, symlinks=follow_links, workers=workers, sparse=sparse)
+            for src, dst, error in failures:
+                log.error('cp: copy failed: %s => %s (%s)' % (src, dst, error))
+            successful = not failures
         elif os.path.exists(src_path):
             if os.path.isdir(dst_path):
                 dst_path = os.path.join(dst_path, os.path.basename(src_path))
-            shutil.copy2(src_path, dst_path)
+            _copy_file(src_path, dst_path, sparse=sparse)
             successful = True
         else:
             log.error('cp: source not found: %s' % src_path)
-    except (OSError, TypeError) as error:
+    except (IOError, OSError, TypeError, Error) as error:
         log.error('cp: execute failed: %s => %s (%s)' % (src_path, dst_path, error))
     return successful
 
 
+def du(path, depth=None, by='dir', one_file_system=False):
+    """Summarize disk usage below path. The result maps each key to an object
+    with the ``count`` of entries, their apparent ``size`` and the
+    ``allocated`` bytes.
+
+      >>> usage = du('/var', depth=1)
+      >>> usage['/var/log'].size
+      52318208
+      >>> du('/home', by='user')[1000].allocated
+      1843200
+
+    Entries are grouped ``by`` directory (cumulative totals for directories
+    up to ``depth`` levels below path, or all of them), owning ``user`` id or
+    file extension (``ext``). Sizes are summed straight from the directory
+    listing stat results and hard linked files are only counted once. A path
+    which isn't a directory is summarized on its own.
+    """
+    try:
+        top = os.path.realpath(path)
+        st = os.lstat(top)
+    except OSError as error:
+        log.error('du: execute failed: %s (%s)' % (path, error))
+        return obj(grow=False)
+    if by not in ('dir', 'user', 'ext'):
+        log.error('du: unknown grouping: %s' % by)
+        return obj(grow=False)
+    device = st.st_dev
+    prefix = top if top.endswith(os.sep) else top + os.sep
+    totals = {}
+    links = set()
+
+    def walked(e):
+        try:
+            if e.is_symlink():
+                return False
+            return not one_file_system or e.stat(follow_symlinks=False).st_dev == device
+        except OSError:
+            return False
+
+    def add(key, st):
+        if st.st_nlink > 1 and not stat_.S_ISDIR(st.st_mode):
+            if (st.st_dev, st.st_ino) in links:
+                return
+            links.add((st.st_dev, st.st_ino))
+        total = totals.get(key)
+        if total is None:
+            total = totals[key] = [0, 0, 0]
+        total[0] += 1
+        total[1] += st.st_size
+        total[2] += getattr(st, 'st_blocks', 0) * 512
+
+    descend = None
+    if one_file_system:
+        descend = lambda e, d: walked(e)
+    walk = _walk(top, descend=descend)
+    if not stat_.S_ISDIR(st.st_mode):
+        # like du, a file is summarized on its own
+        walk = []
+        if by == 'dir':
+            add(top, st)
+        elif by == 'user':
+            add(st.st_uid, st)
+        else:
+            add(os.path.splitext(top)[1], st)
+    for root, entry, d, dirs, files in walk:
+        if by == 'dir':
+            if depth is None or d <= depth:
+                key = root
+            else:
+                key = os.path.join(top, *root[len(prefix):].split(os.sep)[:depth])
+        try:
+            st = os.lstat(root) if entry is None else entry.stat(follow_symlinks=False)
+        except OSError:
+            continue
+        entries = [(e, True) for e in dirs if not walked(e)] + [(e, False) for e in files]
+        for e, is_dir in [(None, True)] + entries:
+            if e is not None:
+                try:
+                    st = e.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+            if by == 'dir':
+                add(key, st)
+            elif by == 'user':
+                add(st.st_uid, st)
+            else:
+                add('' if is_dir else os.path.splitext(e.name)[1], st)
+
+    if by == 'dir':
+        # roll sub directory totals up into their parents
+        for key in sorted(totals, key=lambda k: k.count(os.sep), reverse=True):
+            if key != top:
+                parent = totals.setdefault(os.path.dirname(key), [0, 0, 0])
+                for i, value in enumerate(totals[key]):
+                    parent[i] += value
+    data = {}
+    for key, total in totals.items():
+        data[key] = obj({'count': total[0], 'size': total[1], 'allocated': total[2]}, grow=False)
+    return obj(data, grow=False)
+
+
+def _hash_file(path, size=None, buffer_size=1024 * 1024):
+    """Return the sha256 digest of a file, or of its first and last size
+    bytes when size is set."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if size is None:
+            while True:
+                data = f.read(buffer_size)
+                if not data:
+                    break
+                digest.update(data)
+        else:
+            digest.update(f.read(size))
+            f.seek(0, os.SEEK_END)
+            if f.tell() > size:
+                f.seek(max(f.tell() - size, size))
+                digest.update(f.read(size))
+    return digest.digest()
+
+
+def duplicates(paths, workers=4, min_size=1):
+    """Find files with the same content and return them as a list of lists
+    of paths.
+
+      >>> for group in duplicates(find('/srv/media').filter(file=True)):
+      ...     for path in group[1:]:
+      ...         rm(path)
+
+    Files are grouped by size first, then by a hash of their first and last
+    64KiB and only the remaining candidates are hashed completely (using up
+    to ``workers`` threads). Paths which are hard links to a file that was
+    already seen are skipped, as are files smaller than ``min_size``.
+    """
+    edge = 64 * 1024
+    sizes = {}
+    inodes = set()
+    for p in paths:
+        p = path(p)
+        try:
+            if not p.stat.file or p.stat.size < min_size:
+                continue
+            inode = (p.stat.device, p.stat.inode)
+        except OSError:
+            continue
+        if inode in inodes:
+            continue
+        inodes.add(inode)
+        sizes.setdefault(p.stat.size, []).append(p)
+
+    def group(groups, size=None):
+        def digest(p):
+            try:
+                return _hash_file(p, size=size)
+            except (IOError, OSError) as error:
+                log.error('duplicates: unable to read: %s (%s)' % (p, error))
+        candidates = [(key, p) for key, g in groups for p in g]
+        result = {}
+        for (key, p), value in zip(candidates, _map(digest, [c[1] for c in candidates], workers=workers)):
+            if value is not None:
+                result.setdefault((key, value), []).append(p)
+        return sorted((key[0], g) for key, g in result.items() if len(g) > 1)
+
+    groups = group([(s, g) for s, g in sorted(sizes.items()) if len(g) > 1], size=edge)
+    # the first and last bytes already cover small files completely
+    result = [g for s, g in groups if s <= 2 * edge]
+    result.extend(g for s, g in group([(s, g) for s, g in groups if s > 2 * edge]))
+    return result
+
+
 class Env(collections.MutableMapping):
     """Get and set environment variables.
 
@@ -290,8 +738,415 @@ def exit(code=0, text=''):
         sys.exit(0)
 
 
+def _map(func, items, workers=1):
+    """Call func for each item using up to workers threads and return the
+    results in order."""
+    items = iter(items)
+    if workers is None or workers <= 1:
+        return [func(item) for item in items]
+    lock = threading.Lock()
+    results = {}
+    errors = []
+
+    def work():
+        while not errors:
+            with lock:
+                try:
+                    index, item = next(items)
+                except StopIteration:
+                    return
+            try:
+                results[index] = func(item)
+            except Exception as error:
+                errors.append(error)
+
+    items = enumerate(items)
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return [results[index] for index in sorted(results)]
+
+
+def _arg_max():
+    """Return the number of bytes a command line can safely use."""
+    try:
+        size = os.sysconf(str('SC_ARG_MAX'))
+    except (AttributeError, ValueError, OSError):
+        size = -1
+    if size <= 0:
+        size = 131072
+    size -= sum(len(n) + len(v) + 2 + 2 * struct.calcsize('P') for n, v in os.environ.items())
+    # the shell gets the whole command as a single argument, which Linux
+    # limits to 128KiB
+    return max(min(size, 131072) - 2048, 4096)
+
+
+class _DirEntry(object):
+    """A minimal os.DirEntry used when scandir isn't available."""
+
+    def __init__(self, root, name):
+        self.name = name
+        self.path = os.path.join(root, name)
+
+    def stat(self, follow_symlinks=True):
+        if not hasattr(self, '_lstat'):
+            self._lstat = os.lstat(self.path)
+        if not follow_symlinks or not stat_.S_ISLNK(self._lstat.st_mode):
+            return self._lstat
+        if not hasattr(self, '_stat'):
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_symlink(self):
+        return stat_.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat_.S_ISDIR(self.stat(follow_symlinks=follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat_.S_ISREG(self.stat(follow_symlinks=follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+
+def _listdir(path):
+    if _scandir is not None:
+        return list(_scandir(path))
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+
+def _scan(root, depth, prune=None, descend=None, listdir=_listdir):
+    """List root (at depth) and return (dirs, files, children) lists of
+    DirEntry objects, where children are the directories that should be
+    walked next.
+    """
+    dirs = []
+    files = []
+    children = []
+    for e in listdir(root):
+        try:
+            is_dir = e.is_dir()
+        except OSError:
+            is_dir = False
+        if not is_dir:
+            files.append(e)
+            continue
+        if prune is not None and prune(e, depth + 1):
+            continue
+        dirs.append(e)
+        try:
+            if e.is_symlink():
+                continue
+        except OSError:
+            continue
+        if descend is None or descend(e, depth + 1):
+            children.append(e)
+    return dirs, files, children
+
+
+def _walk(top, top_down=True, prune=None, descend=None, listdir=_listdir):
+    """Walk a directory tree like os.walk, but yield a
+    (root, entry, depth, dirs, files) tuple where entry is the DirEntry of
+    root (None for top), depth is the number of levels below top and
+    dirs/files are lists of DirEntry objects.
+
+    Symbolic links to directories are listed in dirs but aren't followed.
+    Directories for which prune(entry, depth) is true are left out of dirs
+    completely and directories for which descend(entry, depth) is false are
+    listed but not walked. When walking top down the dirs list can also be
+    modified in place to control which directories are visited.
+
+    Directories are listed with listdir, which returns DirEntry like objects.
+    """
+    stack = [(top, None, 0, None)]
+    while stack:
+        root, entry, depth, result = stack.pop()
+        if result is not None:
+            yield result
+            continue
+        try:
+            dirs, files, children = _scan(root, depth, prune=prune, descend=descend, listdir=listdir)
+        except OSError:
+            continue
+        result = (root, entry, depth, dirs, files)
+        if top_down:
+            yield result
+        else:
+            stack.append((root, entry, depth, result))
+        if top_down:
+            # dirs may have been modified in place
+            keep = set(dirs)
+            children = [e for e in children if e in keep]
+        for e in reversed(children):
+            stack.append((e.path, e, depth + 1, None))
+
+
+def _walk_parallel(top, top_down=True, prune=None, descend=None, workers=2):
+    """Walk a directory tree like _walk, but list directories concurrently
+    using a pool of worker threads.
+
+    Directories are yielded in the order their listings complete, so sibling
+    order isn't stable, but a directory is always yielded before (top down) or
+    after (bottom up) everything below it. Modifying dirs in place has no
+    effect and prune/descend are called from the worker threads.
+    """
+    tasks = queue.Queue()
+    results = queue.Queue()
+    stop = threading.Event()
+
+    def work():
+        while True:
+            node = tasks.get()
+            if node is None or stop.is_set():
+                return
+            root, entry, depth = node['root'], node['entry'], node['depth']
+            try:
+                dirs, files, children = _scan(root, depth, prune=prune, descend=descend)
+            except OSError:
+                results.put(node)
+                continue
+            except BaseException as error:
+                # re-raised by the consumer, which would wait forever otherwise
+                node['error'] = error
+                results.put(node)
+                continue
+            node['result'] = (root, entry, depth, dirs, files)
+            node['pending'] = len(children)
+            # the parent has to be queued before any of its children finish
+            results.put(node)
+            for e in children:
+                tasks.put({'root': e.path, 'entry': e, 'depth': depth + 1, 'parent': node})
+
+    threads = []
+    for _ in range(workers):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    tasks.put({'root': top, 'entry': None, 'depth': 0, 'parent': None})
+    outstanding = 1
+    try:
+        while outstanding:
+            node = results.get()
+            outstanding -= 1
+            if 'error' in node:
+                raise node['error']
+            result = node.get('result')
+            if result is not None:
+                outstanding += node['pending']
+                if top_down:
+                    yield result
+            if top_down:
+                continue
+            # yield each directory once everything below it has been yielded
+            while node is not None and not node.get('pending'):
+                if node.get('result') is not None:
+                    yield node['result']
+                node = node['parent']
+                if node is not None:
+                    node['pending'] -= 1
+    finally:
+        stop.set()
+        for _ in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+
+
+class _IndexEntry(object):
+    """A DirEntry like object for an entry stored in a _FindIndex."""
+
+    def __init__(self, root, name, link, data):
+        self.name = name
+        self.path = os.path.join(root, name)
+        self._link = bool(link)
+        self._stat = os.stat_result(data)
+
+    def stat(self, follow_symlinks=True):
+        return self._stat
+
+    def is_symlink(self):
+        return self._link
+
+    def is_dir(self, follow_symlinks=True):
+        return stat_.S_ISDIR(self._stat.st_mode) and (follow_symlinks or not self._link)
+
+    def is_file(self, follow_symlinks=True):
+        return stat_.S_ISREG(self._stat.st_mode) and (follow_symlinks or not self._link)
+
+
+class _FindIndex(object):
+    """A SQLite database of directory listings and stat results.
+
+    Directories are only listed again when their mtime has changed (or never
+    when refresh is false and they've been indexed before), so the stat data
+    of a file is only updated when its directory changes.
+    """
+
+    def __init__(self, path, refresh=True):
+        self.path = path
+        self.refresh = refresh
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'parent TEXT NOT NULL, name TEXT NOT NULL, link INTEGER NOT NULL, '
+            'mode INTEGER, ino INTEGER, dev INTEGER, nlink INTEGER, uid INTEGER, '
+            'gid INTEGER, size INTEGER, atime INTEGER, mtime INTEGER, ctime INTEGER, '
+            'PRIMARY KEY (parent, name))'
+        )
+        self.db.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime REAL NOT NULL)')
+
+    def _load(self, root):
+        rows = self.db.execute(
+            'SELECT name, link, mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime '
+            'FROM entries WHERE parent = ?', (root,)
+        )
+        return [_IndexEntry(root, row[0], row[1], row[2:]) for row in rows]
+
+    def _delete(self, root):
+        # everything below root, "0" is the character after the separator
+        args = (root, root + os.sep, root + '0')
+        self.db.execute('DELETE FROM entries WHERE parent = ? OR (parent >= ? AND parent < ?)', args)
+        self.db.execute('DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)', args)
+
+    def listdir(self, root):
+        row = self.db.execute('SELECT mtime FROM dirs WHERE path = ?', (root,)).fetchone()
+        if row is not None and not self.refresh:
+            return self._load(root)
+        mtime = os.stat(root).st_mtime
+        if row is not None and row[0] == mtime:
+            return self._load(root)
+        result = []
+        for e in _listdir(root):
+            try:
+                link = e.is_symlink()
+                try:
+                    data = e.stat()
+                except OSError:
+                    data = e.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            result.append(_IndexEntry(root, e.name, link, tuple(data)[:10]))
+        names = set(e.name for e in result if e.is_dir() and not e.is_symlink())
+        for e in self._load(root):
+            if e.is_dir() and not e.is_symlink() and e.name not in names:
+                self._delete(e.path)
+        self.db.execute('DELETE FROM entries WHERE parent = ?', (root,))
+        self.db.executemany(
+            'INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(root, e.name, int(e.is_symlink())) + tuple(e.stat())[:10] for e in result],
+        )
+        self.db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (root, mtime))
+        return result
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_DONT_FOLLOW = 0x02000000
+_IN_ISDIR = 0x40000000
+_IN_CLOEXEC = 0o2000000
+_IN_NONBLOCK = 0o4000
+
+_IN_WATCH = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO |
+             _IN_CREATE | _IN_DELETE | _IN_ONLYDIR | _IN_DONT_FOLLOW)
+
+
+class _Inotify(object):
+    """A minimal ctypes binding for Linux inotify."""
+
+    _libc = None
+
+    def __init__(self):
+        if ctypes is None or not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        if _Inotify._libc is None:
+            _Inotify._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._check(self._libc.inotify_init1(_IN_CLOEXEC | _IN_NONBLOCK))
+        self.poller = _Poller()
+        self.poller.register(self.fd)
+
+    def _check(self, value):
+        if value < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        return value
+
+    def add(self, path, mask=_IN_WATCH):
+        if isinstance(path, unicode_type):
+            path = path.encode(sys.getfilesystemencoding())
+        return self._check(self._libc.inotify_add_watch(self.fd, path, mask))
+
+    def remove(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds for events and return them as a list of
+        (wd, mask, name) tuples."""
+        if not self.poller.poll(timeout):
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as error:
+            if error.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+            offset += 16 + length
+            events.append((wd, mask, name.decode(sys.getfilesystemencoding())))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _find_path(entry, links=False):
+    """Create a path from a DirEntry found below a real path, reusing its
+    type and stat information. Symlinks are resolved unless links is true,
+    in which case the path of the link itself is kept."""
+    try:
+        link = entry.is_symlink()
+    except OSError:
+        link = False
+    if link and not links:
+        p = path(entry.path)
+    else:
+        p = unicode_type.__new__(path, entry.path)
+    p._stat = _ops_stat(p)
+    p._stat._entry = entry
+    return p
+
+
 class _FindRule(object):
 
+    # relative cost of evaluating a rule: 0 only needs the path, 1 can be
+    # answered by the directory entry type and 2 needs a stat
+    cost = 2
+
     def __init__(self, exclude=False):
         self.exclude = exclude
 
@@ -306,6 +1161,8 @@ class _FindRule(object):
 
 class _FindDirectoryRule(_FindRule):
 
+    cost = 1
+
     def __init__(self, value, **kwargs):
         super(_FindDirectoryRule, self).__init__(**kwargs)
         self.value = value
@@ -316,6 +1173,8 @@ class _FindDirectoryRule(_FindRule):
 
 class _FindFileRule(_FindRule):
 
+    cost = 1
+
     def __init__(self, value, **kwargs):
         super(_FindFileRule, self).__init__(**kwargs)
         self.value = value
@@ -325,14 +1184,143 @@ class _FindFileRule(_FindRule):
 
 
 class _FindNameRule(_FindRule):
+    """Match the base name against a glob pattern, or any of a list of
+    patterns. The patterns argument (used by _compile_rules to merge rules)
+    behaves like a separate rule for each pattern, but is checked with a
+    single regular expression.
+    """
 
-    def __init__(self, pattern, **kwargs):
+    cost = 0
+
+    def __init__(self, pattern=None, patterns=None, **kwargs):
         super(_FindNameRule, self).__init__(**kwargs)
         self.pattern = pattern
+        self.patterns = patterns
+        if patterns is not None:
+            patterns = [fnmatch.translate(p) for p in patterns]
+            if self.exclude:
+                regex = '|'.join(['(?:%s)' % p for p in patterns])
+            else:
+                regex = ''.join(['(?=%s)' % p for p in patterns])
+        elif isinstance(pattern, (list, tuple)):
+            regex = '|'.join(['(?:%s)' % fnmatch.translate(p) for p in pattern])
+        else:
+            regex = fnmatch.translate(pattern)
+        self.regex = re.compile(regex)
 
     def __call__(self, path):
         name = os.path.basename(path)
-        return self.render(fnmatch.fnmatch(name, self.pattern))
+        return self.render(self.regex.match(name) is not None)
+
+
+class _FindStatRule(_FindRule):
+    """Compare a numeric stat field (size, nlink, uid or gid). A value of
+    None (an unknown user or group) never compares true."""
+
+    def __init__(self, field, op, value, **kwargs):
+        super(_FindStatRule, self).__init__(**kwargs)
+        self.field = field
+        self.op = op
+        self.value = value
+
+    def __call__(self, path):
+        try:
+            value = getattr(path.stat, 'st_%s' % self.field)
+        except OSError:
+            # a dangling symlink or an entry removed during the walk
+            return False
+        if self.value is None:
+            return self.render(False)
+        if not self.op or self.op == 'exact':
+            return self.render(value == self.value)
+        elif self.op == 'lt':
+            return self.render(value < self.value)
+        elif self.op == 'lte':
+            return self.render(value <= self.value)
+        elif self.op == 'gt':
+            return self.render(value > self.value)
+        elif self.op == 'gte':
+            return self.render(value >= self.value)
+        return self.render()
+
+
+class _FindModeRule(_FindRule):
+    """Match permission bits exactly, or check that all or any of the
+    specified bits are set."""
+
+    def __init__(self, op, value, **kwargs):
+        super(_FindModeRule, self).__init__(**kwargs)
+        self.op = op
+        self.value = value.numeric if isinstance(value, _ops_mode) else value
+
+    def __call__(self, path):
+        try:
+            value = stat_.S_IMODE(path.stat.st_mode)
+        except OSError:
+            return False
+        if not self.op or self.op == 'exact':
+            return self.render(value == self.value)
+        elif self.op == 'all':
+            return self.render(value & self.value == self.value)
+        elif self.op == 'any':
+            return self.render(bool(value & self.value))
+        return self.render()
+
+
+class _FindLinkRule(_FindRule):
+
+    cost = 1
+
+    def __init__(self, value, **kwargs):
+        super(_FindLinkRule, self).__init__(**kwargs)
+        self.value = value
+
+    def __call__(self, path):
+        return self.render(path.stat.link == self.value)
+
+
+class _FindEmptyRule(_FindRule):
+    """Match empty files and directories, directories have to be listed."""
+
+    cost = 3
+
+    def __init__(self, value, **kwargs):
+        super(_FindEmptyRule, self).__init__(**kwargs)
+        self.value = value
+
+    def __call__(self, path):
+        if path.stat.file:
+            try:
+                empty = path.stat.size == 0
+            except OSError:
+                return False
+        elif path.stat.directory:
+            try:
+                empty = not os.listdir(path)
+            except OSError:
+                empty = False
+        else:
+            empty = False
+        return self.render(empty == self.value)
+
+
+def _compile_rules(rules):
+    """Merge name rules and order rules so the cheapest ones run first."""
+    names = {}
+    result = []
+    for rule in rules:
+        if type_(rule) is _FindNameRule and not isinstance(rule.pattern, (list, tuple)):
+            patterns = rule.patterns if rule.patterns is not None else [rule.pattern]
+            names.setdefault(rule.exclude, []).extend(patterns)
+        else:
+            result.append(rule)
+    for exclude, patterns in sorted(names.items()):
+        if len(patterns) == 1:
+            result.append(_FindNameRule(patterns[0], exclude=exclude))
+        else:
+            result.append(_FindNameRule(patterns=patterns, exclude=exclude))
+    result.sort(key=lambda rule: rule.cost)
+    return result
 
 
 class _FindTimeRule(_FindRule):
@@ -387,55 +1375,220 @@ class find(object):
       ...     print('%s is owned by %s' % (path, path.stat.user.name))
       /tmp/test1.py is owned by silas
       /tmp/test2.py is owned by root
+
+    Besides ``name``, ``file``, ``directory`` and ``atime``/``ctime``/``mtime``
+    entries can be matched on ``size``, ``nlink``, ``user`` and ``group`` (all
+    with ``__lt``, ``__lte``, ``__gt`` and ``__gte``), ``mode`` (with
+    ``__all`` and ``__any``), ``link`` and ``empty``. User and group names
+    are resolved once, so every rule is answered from the entry's stat, and
+    unknown names match nothing. Entries which can't be stat'd (dangling
+    symlinks) never match stat rules. Symlinks are yielded as their target
+    unless there's a ``link`` rule, then they're yielded as the link itself.
+    ``name`` can also be a list of patterns, which matches names that match
+    any of them.
+
+      >>> for path in find('/var/log').filter(size__gt=2 ** 20, user='syslog', mode__any=0o002):
+      ...     print(path)
+
+    Directory listings can be spread across a pool of threads with the
+    ``workers`` option, which helps on high latency (network) filesystems.
+    Directories are still yielded before (``top_down``) or after their
+    contents, but the order of siblings isn't stable.
+
+      >>> for path in find('/home', workers=16):
+      ...     print(path)
+
+    Directories matching prune rules are skipped along with everything below
+    them, ``min_depth`` and ``max_depth`` limit results to a range of levels
+    below the search path (which is at depth 0) and ``one_file_system``
+    doesn't descend into directories on other filesystems.
+
+      >>> for path in find('/src', max_depth=3).prune(name='.git').prune(name='node_modules'):
+      ...     print(path)
+
+    Directory listings and stat results can be kept in an ``index`` (a SQLite
+    database file), after which only directories whose mtime changed are
+    listed again. With ``refresh=False`` results come straight from the index
+    without touching indexed directories. Index lookups aren't threaded, so
+    ``workers`` is ignored.
+
+      >>> for path in find('/data', index='/var/tmp/data.idx').filter(name='*.log'):
+      ...     print(path)
+
+    The stat results of entries are only refreshed when their directory's
+    mtime changes, which happens when entries are added, removed or renamed
+    but not when a file is written to. Rules on ``size``, times and other
+    stat fields can therefore match stale values for files modified in
+    place (such as appended logs), so don't use an index for those.
     """
 
-    def __init__(self, path, no_peek=False, top_down=False):
+    def __init__(self, path, no_peek=False, top_down=False, workers=None,
+                 min_depth=None, max_depth=None, one_file_system=False,
+                 index=None, refresh=True):
         try:
             self.path = os.path.realpath(path)
         except OSError:
             self.path = None
         self.rules = []
+        self.prune_rules = []
         self.no_peek = no_peek
         self.top_down = top_down
+        self.workers = workers
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.one_file_system = one_file_system
+        self.index = index
+        self.refresh = refresh
 
     def __iter__(self):
-        if self.path is None:
+        setup = self._setup()
+        if setup is None:
             return
-        if self.no_peek and not self.top_down:
+        rules, prune, descend = setup
+        if self.no_peek and not self.top_down and self._in_depth(0):
             p = path(self.path)
-            if self._match(p):
+            if self._match(p, rules):
                 yield p
-        for root_path, dir_list, file_list in os.walk(self.path, topdown=self.top_down):
+        index = None
+        if self.index is not None:
+            if sqlite3 is None:
+                log.error('find: sqlite3 is required to use an index')
+            else:
+                try:
+                    index = _FindIndex(self.index, refresh=self.refresh)
+                except sqlite3.Error as error:
+                    log.error('find: unable to open index: %s (%s)' % (self.index, error))
+        if index is not None:
+            walk = _walk(self.path, top_down=self.top_down, prune=prune,
+                         descend=descend, listdir=index.listdir)
+        elif self.workers and self.workers > 1:
+            walk = _walk_parallel(self.path, top_down=self.top_down, prune=prune,
+                                  descend=descend, workers=self.workers)
+        else:
+            walk = _walk(self.path, top_down=self.top_down, prune=prune, descend=descend)
+        try:
+            for p in self._iter_walk(walk, rules, descend):
+                yield p
+        finally:
+            if index is not None:
+                index.close()
+
+    def _setup(self):
+        """Compile rules and return a (rules, prune, descend) tuple for
+        walking, or None if the search path isn't usable."""
+        if self.path is None:
+            return
+        rules = _compile_rules(self.rules)
+        self._prune_rules = [_compile_rules(r) for r in self.prune_rules]
+        # with a link rule symlinks are yielded as themselves, not their target
+        self._links = any([isinstance(r, _FindLinkRule) for r in self.rules])
+        prune = self._prune if self.prune_rules else None
+        descend = None
+        if self.max_depth is not None or self.one_file_system:
+            try:
+                self._device = os.stat(self.path).st_dev
+            except OSError:
+                return
+            descend = self._descend
+        return rules, prune, descend
+
+    def _iter_walk(self, walk, rules, descend):
+        for root_path, entry, depth, dir_list, file_list in walk:
             if self.no_peek and not self.top_down:
-                for d in dir_list:
-                    p = path(root=root_path, name=d)
-                    if self._match(p):
-                        yield p
+                dirs = dir_list
             else:
-                p = path(root_path)
-                if self._match(p):
+                if self._in_depth(depth):
+                    p = path(root_path) if entry is None else _find_path(entry, self._links)
+                    if self._match(p, rules):
+                        yield p
+                # directories which aren't walked never become a root
+                dirs = []
+                if descend is not None:
+                    for d in dir_list:
+                        try:
+                            if not d.is_symlink() and not descend(d, depth + 1):
+                                dirs.append(d)
+                        except OSError:
+                            pass
+            if not self._in_depth(depth + 1):
+                continue
+            for d in dirs:
+                p = _find_path(d, self._links)
+                if self._match(p, rules):
                     yield p
             for f in file_list:
-                p = path(root=root_path, name=f)
-                if self._match(p):
+                p = _find_path(f, self._links)
+                if self._match(p, rules):
                     yield p
 
-    def _add_rule(self, data, exclude=False):
+    def _add_rule(self, data, exclude=False, rules=None):
+        if rules is None:
+            rules = self.rules
         for name, value in data.items():
             n, p, op = name.partition('__')
             if n == 'name':
-                self.rules.append(_FindNameRule(value, exclude=exclude))
+                rules.append(_FindNameRule(value, exclude=exclude))
             elif n == 'directory':
-                self.rules.append(_FindDirectoryRule(value, exclude=exclude))
+                rules.append(_FindDirectoryRule(value, exclude=exclude))
             elif n == 'file':
-                self.rules.append(_FindFileRule(value, exclude=exclude))
+                rules.append(_FindFileRule(value, exclude=exclude))
             elif n in ('atime', 'ctime', 'mtime'):
-                self.rules.append(_FindTimeRule(n, op, value, exclude=exclude))
+                rules.append(_FindTimeRule(n, op, value, exclude=exclude))
+            elif n in ('size', 'nlink'):
+                rules.append(_FindStatRule(n, op, value, exclude=exclude))
+            elif n == 'user':
+                if isinstance(value, basestring_type):
+                    value = _ops_user(name=value)
+                if isinstance(value, _ops_user):
+                    if not value:
+                        log.error('find: unknown user %s' % value._name)
+                    value = value.id
+                rules.append(_FindStatRule('uid', op, value, exclude=exclude))
+            elif n == 'group':
+                if isinstance(value, basestring_type):
+                    value = _ops_group(name=value)
+                if isinstance(value, _ops_group):
+                    if not value:
+                        log.error('find: unknown group %s' % value._name)
+                    value = value.id
+                rules.append(_FindStatRule('gid', op, value, exclude=exclude))
+            elif n == 'mode':
+                rules.append(_FindModeRule(op, value, exclude=exclude))
+            elif n == 'link':
+                rules.append(_FindLinkRule(value, exclude=exclude))
+            elif n == 'empty':
+                rules.append(_FindEmptyRule(value, exclude=exclude))
             else:
                 log.error('unknown find rule %s=%s' % (name, value))
 
-    def _match(self, path):
-        for rule in self.rules:
+    def _in_depth(self, depth):
+        if self.min_depth is not None and depth < self.min_depth:
+            return False
+        if self.max_depth is not None and depth > self.max_depth:
+            return False
+        return True
+
+    def _descend(self, entry, depth):
+        if self.max_depth is not None and depth >= self.max_depth:
+            return False
+        if self.one_file_system:
+            try:
+                return entry.stat(follow_symlinks=False).st_dev == self._device
+            except OSError:
+                return False
+        return True
+
+    def _prune(self, entry, depth):
+        p = _find_path(entry, self._links)
+        for rules in self._prune_rules:
+            if self._match(p, rules):
+                return True
+        return False
+
+    def _match(self, path, rules=None):
+        if rules is None:
+            rules = self.rules
+        for rule in rules:
             if not rule(path):
                 return False
         return True
@@ -448,6 +1601,212 @@ class find(object):
         self._add_rule(kwargs, exclude=True)
         return self
 
+    def prune(self, **kwargs):
+        rules = []
+        self._add_rule(kwargs, rules=rules)
+        self.prune_rules.append(rules)
+        return self
+
+    def execute(self, command, batch=False, workers=1, **kwargs):
+        """Run a command for the matching paths and return a list of run
+        results. The paths are substituted for ``${path}``, or appended to
+        the command if it isn't used.
+
+          >>> for result in find('/var/log').filter(name='*.1').execute('gzip', batch=True, workers=4):
+          ...     if not result:
+          ...         print(result.stderr)
+
+        With ``batch`` paths are grouped into as few commands as fit in the
+        system's argument size limit (like ``find -exec {} +``), or in groups
+        of at most ``batch`` paths when it's a number. Up to ``workers``
+        commands are run at the same time and the remaining keyword arguments
+        are passed to run. Commands can also be argv lists, where the paths
+        replace a ``${path}`` argument (appended if there isn't one).
+
+          >>> find('/srv/upload').filter(name='*.tmp').execute(['rm', '-f', '--'], batch=True)
+        """
+        if isinstance(command, (list, tuple)):
+            if not [a for a in command if re.match(r'^\$(path|\{path\})$', unicode_type(a))]:
+                command = list(command) + ['${path}']
+        elif '${path}' not in command and '$path' not in command:
+            command += ' ${path}'
+        if batch:
+            paths = self._batches(command, None if batch is True else batch)
+        else:
+            paths = iter(self)
+
+        def commands():
+            for p in paths:
+                options = dict(kwargs)
+                options['path'] = p
+                yield command, options
+
+        return list(run_many(commands(), concurrency=workers or 1))
+
+    def _batches(self, command, count=None):
+        if isinstance(command, (list, tuple)):
+            # argv paths aren't quoted, each argument ends with a NUL
+            size = _arg_max() - sum([len(unicode_type(a).encode('utf-8')) + 1 for a in command])
+            quote = lambda p: p
+        else:
+            size = _arg_max() - len(command.encode('utf-8'))
+            quote = pipes.quote
+        paths = []
+        length = 0
+        for p in self:
+            n = len(quote(p).encode('utf-8')) + 1
+            if paths and (length + n > size or (count and len(paths) >= count)):
+                yield paths
+                paths = []
+                length = 0
+            paths.append(p)
+            length += n
+        if paths:
+            yield paths
+
+    def watch(self, initial=False, timeout=None, poll=False, interval=1.0):
+        """Walk the path once and then yield (event, path) tuples, where event
+        is ``add``, ``modify`` or ``delete``, as matching entries change.
+
+          >>> for event, path in find('/srv/incoming').filter(name='*.tar.gz').watch():
+          ...     print('%s %s' % (event, path))
+          add /srv/incoming/release.tar.gz
+          modify /srv/incoming/release.tar.gz
+
+        Changes are detected with inotify, falling back to rescanning the tree
+        if events were lost. With ``poll`` (or where inotify isn't available)
+        the tree is rescanned every ``interval`` seconds instead. Existing
+        entries are reported as added when ``initial`` is true and the
+        generator returns after ``timeout`` seconds without events.
+        """
+        setup = self._setup()
+        if setup is None:
+            return
+        rules, prune, descend = setup
+        inotify = None
+        if not poll:
+            try:
+                inotify = _Inotify()
+            except OSError as error:
+                log.warning('find: watch falling back to polling (%s)' % error)
+        watches = {}
+        snapshot = {}
+
+        def check(name, depth):
+            try:
+                p = path(name)
+                data = p.stat.data
+            except OSError:
+                p = None
+            if p is not None and self._in_depth(depth) and self._match(p, rules):
+                signature = (data.st_mode, data.st_ino, data.st_dev, data.st_nlink, data.st_uid,
+                             data.st_gid, data.st_size, data.st_mtime, data.st_ctime)
+                old = snapshot.get(name)
+                snapshot[name] = (signature, p)
+                if old is None:
+                    return ('add', p)
+                elif old[0] != signature:
+                    return ('modify', p)
+                return
+            old = snapshot.pop(name, None)
+            if old is not None:
+                return ('delete', old[1])
+
+        def scan(top, base, seen=None):
+            events = []
+            walk = _walk(
+                top,
+                prune=None if prune is None else lambda e, depth: prune(e, base + depth),
+                descend=None if descend is None else lambda e, depth: descend(e, base + depth),
+            )
+            for root, entry, depth, dirs, files in walk:
+                depth += base
+                if inotify is not None:
+                    try:
+                        watches[inotify.add(root)] = (root, depth)
+                    except OSError as error:
+                        log.error('find: unable to watch: %s (%s)' % (root, error))
+                names = [(e.path, depth + 1) for e in dirs + files]
+                if entry is None:
+                    names.insert(0, (root, depth))
+                for name, name_depth in names:
+                    if seen is not None:
+                        seen.add(name)
+                    event = check(name, name_depth)
+                    if event is not None:
+                        events.append(event)
+            return events
+
+        def rescan():
+            seen = set()
+            events = scan(self.path, 0, seen)
+            for name in [name for name in snapshot if name not in seen]:
+                events.append(('delete', snapshot.pop(name)[1]))
+            return events
+
+        def remove(name):
+            events = []
+            prefix = name + os.sep
+            for key in [key for key in snapshot if key.startswith(prefix)]:
+                events.append(('delete', snapshot.pop(key)[1]))
+            for wd, (root, depth) in list(watches.items()):
+                if root == name or root.startswith(prefix):
+                    del watches[wd]
+                    inotify.remove(wd)
+            return events
+
+        def handle(raw):
+            events = []
+            for wd, mask, name in raw:
+                if mask & _IN_Q_OVERFLOW:
+                    events.extend(rescan())
+                    continue
+                if wd not in watches:
+                    continue
+                if mask & _IN_IGNORED:
+                    del watches[wd]
+                    continue
+                if not name:
+                    continue
+                root, depth = watches[wd]
+                name = os.path.join(root, name)
+                if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+                    entry = _DirEntry(root, os.path.basename(name))
+                    if prune is not None and prune(entry, depth + 1):
+                        continue
+                    if descend is None or descend(entry, depth + 1):
+                        events.extend(scan(name, depth + 1))
+                        continue
+                elif mask & _IN_ISDIR and mask & (_IN_DELETE | _IN_MOVED_FROM):
+                    events.extend(remove(name))
+                event = check(name, depth + 1)
+                if event is not None:
+                    events.append(event)
+            return events
+
+        try:
+            events = scan(self.path, 0)
+            if initial:
+                for event in events:
+                    yield event
+            idle = 0
+            while timeout is None or idle < timeout:
+                if inotify is None:
+                    time.sleep(interval)
+                    events = rescan()
+                    idle += interval
+                else:
+                    start = time.time()
+                    events = handle(inotify.read(None if timeout is None else timeout - idle))
+                    idle += time.time() - start
+                if events:
+                    idle = 0
+                for event in events:
+                    yield event
+        finally:
+            if inotify is not None:
+                inotify.close()
+
 
 class group(object):
     """Get information about a group.
@@ -810,10 +2169,11 @@ class path(unicode_type):
       root
     """
 
+    stat = property(_path_stat_get, _path_stat_set)
+
     def __new__(cls, value=None, stat=None, root=None, name=None):
         if isinstance(value, path):
             return value
-        cls.stat = property(_path_stat_get, _path_stat_set)
         if root is not None and name is not None:
             value = os.path.join(root, name)
         try:
@@ -854,22 +2214,207 @@ def rm(path, recursive=False):
     return True
 
 
-def run(command, **kwargs):
-    """Run a shell command and wait for the response. The result object will
-    resolve to True if result.code == 0 and output/error results can be
-    retrieved from result.stdout and result.stderr variables.
+class _Poller(object):
+    """Wait for file descriptors to become readable or writable. This uses
+    poll() where available, so there's no FD_SETSIZE limit.
+    """
 
-      >>> result = run('echo ${content}', content='Some $%^$## "" + \' content')
-      >>> result.code
-      0
-      >>> if result:
-      ...     print('Stdout: %s' % result.stdout)
-      ... else:
-      ...     print('Stderr: %s' % result.stderr)
-      Stdout: Some $%^$## "" + ' content
-      >>> print(result.command)
-      echo 'Some $%^$## "" + '"'"' content'
+    def __init__(self):
+        self._fds = {}
+        self._poll = select.poll() if hasattr(select, 'poll') else None
+
+    def __len__(self):
+        return len(self._fds)
+
+    def register(self, fd, write=False):
+        self._fds[fd] = write
+        if self._poll is not None:
+            self._poll.register(fd, select.POLLOUT if write else select.POLLIN)
+
+    def unregister(self, fd):
+        if self._fds.pop(fd, None) is not None and self._poll is not None:
+            self._poll.unregister(fd)
+
+    def poll(self, timeout=None):
+        """Return the file descriptors which are ready (or closed), waiting
+        at most timeout seconds."""
+        try:
+            if self._poll is not None:
+                return [fd for fd, event in self._poll.poll(None if timeout is None else timeout * 1000)]
+            read = [fd for fd, write in self._fds.items() if not write]
+            write = [fd for fd, write in self._fds.items() if write]
+            ready = select.select(read, write, [], timeout)
+            return ready[0] + ready[1]
+        except (select.error, OSError) as error:
+            if error.args[0] == errno.EINTR:
+                return []
+            raise
+
+
+class _Output(object):
+    """Collect the output of a pipe in chunks (unless keep is false) and pass
+    complete lines to an optional callback. Once more than max_output bytes
+    have been collected they're moved to a temporary file in spill_dir.
     """
+
+    size = 64 * 1024
+
+    def __init__(self, callback=None, keep=True, max_output=None, spill_dir=None):
+        self.callback = callback
+        self.keep = keep
+        self.max_output = max_output
+        self.spill_dir = spill_dir
+        self.chunks = []
+        self.length = 0
+        self.file = None
+        self._line = b''
+
+    def read(self, fd):
+        """Read a chunk from fd and return it (empty at end of file)."""
+        data = os.read(fd, self.size)
+        self.feed(data)
+        return data
+
+    def feed(self, data):
+        """Add a chunk of output, an empty chunk marks the end of file."""
+        if data:
+            if self.file is not None:
+                self.file.write(data)
+            elif self.keep:
+                self.chunks.append(data)
+                self.length += len(data)
+                if self.max_output is not None and self.length > self.max_output:
+                    self.file = tempfile.TemporaryFile(dir=self.spill_dir)
+                    for chunk in self.chunks:
+                        self.file.write(chunk)
+                    self.chunks = []
+            if self.callback:
+                lines = (self._line + data).split(b'\n')
+                self._line = lines.pop()
+                for line in lines:
+                    self.callback(line + b'\n')
+        elif self.callback and self._line:
+            self.callback(self._line)
+            self._line = b''
+
+    def getvalue(self):
+        if self.file is not None:
+            self.file.flush()
+            return _SpillBuffer(self.file)
+        return b''.join(self.chunks)
+
+
+class _SpillBuffer(object):
+    """Command output stored in a temporary file, which is read lazily.
+
+      >>> result = run('pg_dump ${db}', db='app', max_output=2 ** 26)
+      >>> len(result.stdout)
+      2147483648
+      >>> for chunk in result.stdout:
+      ...     archive.write(chunk)
+      >>> result.stdout.mmap().find(b'CREATE TABLE')
+      412
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.file.seek(0)
+
+    def __len__(self):
+        return os.fstat(self.file.fileno()).st_size
+
+    def __iter__(self):
+        self.file.seek(0)
+        while True:
+            data = self.file.read(1024 * 1024)
+            if not data:
+                break
+            yield data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def getvalue(self):
+        self.file.seek(0)
+        return self.file.read()
+
+    def mmap(self):
+        return mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self.file.close()
+
+
+class _Input(object):
+    """Write the stdin of a process in chunks, from bytes, a path, a file
+    object, an iterator of chunks or the stdout of a run_stream()."""
+
+    size = 64 * 1024
+
+    def __init__(self, source):
+        self.source = source
+        self.chunks = None
+        self.pending = b''
+
+    @staticmethod
+    def streams(source):
+        """Return whether source is read in chunks rather than being the
+        input itself."""
+        if isinstance(source, (path, run_stream)) or hasattr(source, 'read'):
+            return True
+        return hasattr(source, '__iter__') and not isinstance(source, (basestring_type, bytes_type))
+
+    def __iter__(self):
+        source = self.source
+        if isinstance(source, bytes_type):
+            for i in range(0, len(source), self.size):
+                yield source[i:i + self.size]
+        elif isinstance(source, path):
+            with open(source, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.size), b''):
+                    yield chunk
+        elif hasattr(source, 'read'):
+            for chunk in iter(lambda: source.read(self.size), source.read(0)):
+                yield chunk if isinstance(chunk, bytes_type) else chunk.encode('utf-8')
+        elif isinstance(source, run_stream):
+            for name, chunk in source:
+                if name == 'stdout':
+                    yield chunk
+        else:
+            for chunk in source:
+                yield chunk if isinstance(chunk, bytes_type) else unicode_type(chunk).encode('utf-8')
+
+    def write(self, fd):
+        """Write some of the input to the non-blocking fd, returns False once
+        everything has been written or the reader went away."""
+        if self.chunks is None:
+            self.chunks = iter(self)
+        while not self.pending:
+            try:
+                self.pending = next(self.chunks)
+            except StopIteration:
+                return False
+        try:
+            count = os.write(fd, self.pending)
+        except OSError as error:
+            if error.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            if error.errno == errno.EPIPE:
+                return False
+            raise
+        self.pending = self.pending[count:]
+        return True
+
+
+def _run_options(command, kwargs):
+    """Substitute run() template variables into command and normalize the
+    options shared by the run functions."""
     env = None
     if 'env' in kwargs:
         if kwargs.get('env_empty'):
@@ -878,14 +2423,21 @@ def run(command, **kwargs):
             env = copy.deepcopy(os.environ)
         env.update(kwargs['env'])
     stdin = kwargs.get('stdin')
+    if stdin is not None and not _Input.streams(stdin):
+        if not isinstance(stdin, (basestring_type, bytes_type)):
+            stdin = unicode_type(stdin)
+        if not isinstance(stdin, bytes_type):
+            stdin = stdin.encode('utf-8')
     stdout = kwargs.get('stdout', False)
     stderr = kwargs.get('stderr', False)
-    combine = kwargs.get('combine', False)
     if stdout is True:
         stdout = sys.stdout.write
     if stderr is True:
         stderr = sys.stderr.write
-    if kwargs:
+    argv = isinstance(command, (list, tuple))
+    if argv:
+        command = _run_argv(command, kwargs)
+    elif kwargs:
         args = {}
         q = pipes.quote
         for name, value in kwargs.items():
@@ -898,51 +2450,1084 @@ def run(command, **kwargs):
             else:
                 args[name] = pipes.quote(unicode_type(value))
         command = string.Template(command).safe_substitute(args)
-    log.debug('run: %s' % command)
-    ref = subprocess.Popen(
-        command,
-        stdin=None if stdin is None else subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT if combine is True else subprocess.PIPE,
-        shell=kwargs.get('shell', True),
-        close_fds=kwargs.get('close_fds', True),
-        env=env,
-        cwd=kwargs.get('cwd', tempfile.gettempdir()),
-    )
-    if stdin is not None:
-        if not isinstance(stdin, basestring_type):
-            stdin = unicode_type(stdin)
-        if not isinstance(stdin, bytes_type):
-            stdin = stdin.encode('utf-8')
-        ref.stdin.write(stdin)
-        ref.stdin.flush()
-        ref.stdin.close()
-    fds = [ref.stdout]
-    if combine is not True:
-        fds.append(ref.stderr)
-    stdout_result = b''
-    stderr_result = b''
-    while fds:
-        for fd in select.select(fds, tuple(), tuple())[0]:
-            line = fd.readline()
-            if line:
-                if fd == ref.stdout:
-                    if stdout:
-                        stdout(line)
-                    stdout_result += line
-                elif fd == ref.stderr:
-                    if stderr:
-                        stderr(line)
-                    stderr_result += line
-            else:
-                fds.remove(fd)
-    ref.wait()
     return obj({
-        'code': ref.returncode,
         'command': command,
-        'stdout': stdout_result,
-        'stderr': stderr_result,
-    }, bool=ref.returncode == 0, grow=False)
+        'env': env,
+        'stdin': stdin,
+        'stdout': stdout,
+        'stderr': stderr,
+        'combine': kwargs.get('combine', False) is True,
+        'shell': kwargs.get('shell', not argv),
+        'close_fds': kwargs.get('close_fds', True),
+        'cwd': kwargs.get('cwd', tempfile.gettempdir()),
+        'timeout': kwargs.get('timeout'),
+        'kill_grace': kwargs.get('kill_grace', 5),
+        'max_output': kwargs.get('max_output'),
+        'spill_dir': kwargs.get('spill_dir'),
+        'metrics': kwargs.get('metrics'),
+    }, grow=False)
+
+
+def _run_argv(command, kwargs):
+    """Substitute template variables into each argument of an argv style
+    command. Nothing is quoted, and an argument which consists only of a
+    reference to a list or dict variable is replaced by its items."""
+    argv = []
+    args = dict((name, unicode_type(value)) for name, value in kwargs.items())
+    for arg in command:
+        arg = unicode_type(arg)
+        match = re.match(r'^\$(?:(\w+)|\{(\w+)\})$', arg)
+        value = kwargs.get(match.group(1) or match.group(2)) if match else None
+        if isinstance(value, (list, tuple)):
+            argv.extend([unicode_type(v) for v in value])
+        elif isinstance(value, dict):
+            for n, v in value.items():
+                argv.extend([unicode_type(n), unicode_type(v)])
+        else:
+            argv.append(string.Template(arg).safe_substitute(args))
+    return argv
+
+
+def _run_output(options, callback, keep=True):
+    return _Output(callback, keep=keep, max_output=options.max_output, spill_dir=options.spill_dir)
+
+
+def _run_result(command, code, stdout, stderr, timed_out=False, duration=None, rusage=None):
+    return obj({
+        'code': code,
+        'command': command,
+        'stdout': stdout,
+        'stderr': stderr,
+        'timed_out': timed_out,
+        'duration': duration,
+        'rusage': rusage,
+    }, bool=code == 0 and not timed_out, grow=False)
+
+
+def _run_rusage(usages):
+    """Sum the CPU times and take the peak resident set size (in bytes) of
+    resource.struct_rusage results."""
+    if not usages:
+        return None
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return obj({
+        'user': sum([usage.ru_utime for usage in usages]),
+        'system': sum([usage.ru_stime for usage in usages]),
+        'max_rss': max([usage.ru_maxrss for usage in usages]) * scale,
+    }, grow=False)
+
+
+def run(command, **kwargs):
+    """Run a shell command and wait for the response. The result object will
+    resolve to True if result.code == 0 and output/error results can be
+    retrieved from result.stdout and result.stderr variables.
+
+      >>> result = run('echo ${content}', content='Some $%^$## "" + \' content')
+      >>> result.code
+      0
+      >>> if result:
+      ...     print('Stdout: %s' % result.stdout)
+      ... else:
+      ...     print('Stderr: %s' % result.stderr)
+      Stdout: Some $%^$## "" + ' content
+      >>> print(result.command)
+      echo 'Some $%^$## "" + '"'"' content'
+
+    With ``timeout`` (in seconds) the command is started in its own process
+    group, which is sent SIGTERM once the timeout expires and SIGKILL
+    ``kill_grace`` seconds later. The result then has ``timed_out`` set and
+    contains the output collected until then.
+
+      >>> result = run('sleep 60', timeout=5)
+      >>> result.timed_out
+      True
+
+    Output beyond ``max_output`` bytes (per stream) is moved to a temporary
+    file in ``spill_dir``, in which case stdout or stderr is a file backed
+    buffer that can be iterated over in chunks, read, measured with len() and
+    memory mapped with its mmap() method.
+
+    ``stdin`` can be a string, or be read in chunks from a path object, a
+    file object, an iterator of chunks or the stdout of a run_stream(). It's
+    written as the command reads it, alongside collecting the output, so
+    large inputs don't have to fit in memory.
+
+      >>> run('psql ${db}', db='app', stdin=path('/backups/app.sql'))
+
+    The result also records the wall clock ``duration`` in seconds and the
+    ``rusage`` of the command (``user`` and ``system`` CPU seconds and peak
+    ``max_rss`` in bytes, None where os.wait4 isn't available). ``metrics``
+    is called with every result, e.g. to report these numbers.
+
+      >>> result = run('gzip -k ${path}', path='dump.sql', metrics=stats.append)
+      >>> result.duration, result.rusage.user, result.rusage.max_rss
+      (2.31, 2.18, 3612672)
+
+    When command is a list it's run directly instead of through a shell.
+    Template variables are substituted into each argument without quoting,
+    and an argument which only references a list variable is expanded to
+    one argument per item.
+
+      >>> run(['tar', '-czf', '${archive}', '${paths}'], archive='a.tgz', paths=['a', 'b']).command
+      ['tar', '-czf', 'a.tgz', 'a', 'b']
+
+    With ``cache`` set to a number of seconds (or True for no expiry) the
+    result is stored in ``cache_store`` (run_cache.default unless set) and
+    returned by later calls with the same command, env, cwd and stdin
+    without running the command again (unless stdin is streamed).
+
+      >>> run('uname -r', cache=300).stdout
+      '3.10.0-123.el7.x86_64\n'
+    """
+    cache = kwargs.pop('cache', None)
+    store = kwargs.pop('cache_store', None) or run_cache.default
+    options = _run_options(command, kwargs)
+    key = None
+    if cache is not None and cache is not False:
+        key = store.key(options)
+    if key is not None:
+        result = store.get(key, options)
+        if result is not None:
+            log.debug('run: cached: %s' % options.command)
+            return result
+    log.debug('run: %s' % options.command)
+    result = _run_process(_Process(options))
+    if key is not None:
+        store.set(key, result, None if cache is True else cache)
+    return result
+
+
+def _run_process(process):
+    """Collect the output of a started process and wait for it to exit."""
+    poller = _Poller()
+    process.register(poller)
+    while poller:
+        for fd in poller.poll(process.timeout()):
+            if fd == process.writing:
+                if not process.write():
+                    poller.unregister(fd)
+            elif not process.read(fd):
+                poller.unregister(fd)
+        process.check()
+    process.wait()
+    return process.result()
+
+
+class run_cache(object):
+    """A least recently used cache of run() results, which is used by
+    ``run(..., cache=ttl)``.
+
+      >>> run_cache.default = run_cache(max_size=100, path='/tmp/job-cache.db')
+      >>> run('lsblk -J', cache=True).code
+      0
+      >>> run_cache.default.invalidate('lsblk -J')
+
+    With ``path`` results are also written to a SQLite database, so they can
+    be shared by short lived processes. Results which timed out or were
+    spilled to disk (see max_output) aren't cached.
+    """
+
+    def __init__(self, max_size=1024, path=None):
+        self.max_size = max_size
+        self.path = path
+        self.entries = {}
+        self.used = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if path is not None:
+            if sqlite3 is None:
+                raise Error('run_cache path requires sqlite3')
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'key TEXT PRIMARY KEY, expires REAL, code INTEGER, stdout BLOB, stderr BLOB, '
+                'duration REAL, user REAL, system REAL, max_rss INTEGER)'
+            )
+            self.db.commit()
+
+    def key(self, options):
+        """Return the cache key for run options, or None if they can't be
+        cached because stdin is streamed."""
+        if options.stdin is not None and not isinstance(options.stdin, bytes_type):
+            return None
+        env = sorted(options.env.items()) if options.env is not None else None
+        data = repr((options.command, env, options.cwd, options.stdin, options.combine, options.shell))
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get(self, key, options):
+        """Return a result for key or None, output is passed to the callbacks
+        in options as if the command ran."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None and self.db is not None:
+                row = self.db.execute(
+                    'SELECT expires, code, stdout, stderr, duration, user, system, max_rss '
+                    'FROM results WHERE key = ?', (key,)
+                ).fetchone()
+                if row is not None:
+                    rusage = None
+                    if row[5] is not None:
+                        rusage = obj({'user': row[5], 'system': row[6], 'max_rss': row[7]}, grow=False)
+                    entry = [row[0], 0, (row[1], bytes_type(row[2]), bytes_type(row[3]), row[4], rusage)]
+                    self.entries[key] = entry
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] <= now:
+                self._delete(key)
+                return None
+            self.used += 1
+            entry[1] = self.used
+        code, stdout, stderr, duration, rusage = entry[2]
+        for data, callback in ((stdout, options.stdout), (stderr, options.stderr)):
+            if callback:
+                output = _run_output(options, callback, keep=False)
+                output.feed(data)
+                output.feed(b'')
+        return _run_result(options.command, code, stdout, stderr, duration=duration, rusage=rusage)
+
+    def set(self, key, result, ttl=None):
+        """Store result under key for ttl seconds (None for no expiry)."""
+        if result.timed_out or not isinstance(result.stdout, bytes_type) or \
+                not isinstance(result.stderr, bytes_type):
+            return
+        expires = None if ttl is None else time.time() + ttl
+        value = (result.code, result.stdout, result.stderr, result.duration, result.rusage)
+        with self.lock:
+            self.used += 1
+            self.entries[key] = [expires, self.used, value]
+            while len(self.entries) > self.max_size:
+                self._delete(min(self.entries, key=lambda k: self.entries[k][1]), disk=False)
+            if self.db is not None:
+                rusage = result.rusage or {}
+                self.db.execute('DELETE FROM results WHERE expires <= ?', (time.time(),))
+                self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                    key, expires, result.code, sqlite3.Binary(result.stdout), sqlite3.Binary(result.stderr),
+                    result.duration, rusage.get('user'), rusage.get('system'), rusage.get('max_rss'),
+                ))
+                self.db.commit()
+
+    def _delete(self, key, disk=True):
+        self.entries.pop(key, None)
+        if disk and self.db is not None:
+            self.db.execute('DELETE FROM results WHERE key = ?', (key,))
+            self.db.commit()
+
+    def invalidate(self, command=None, **kwargs):
+        """Remove the result of command (with the same arguments as run()) or
+        all results when command is None."""
+        with self.lock:
+            if command is None:
+                self.entries = {}
+                if self.db is not None:
+                    self.db.execute('DELETE FROM results')
+                    self.db.commit()
+            else:
+                self._delete(self.key(_run_options(command, kwargs)))
+
+run_cache.default = run_cache()
+
+
+def pipeline(*commands, **kwargs):
+    """Run commands with the stdout of each one connected to the stdin of
+    the next, like ``a | b`` in a shell, and wait for them to finish. Takes
+    the same keyword arguments as run() and returns the same result object,
+    with the exit code of every command in result.codes.
+
+      >>> result = pipeline(['cat', '${path}'], ['grep', '-c', 'error'], path='/var/log/syslog')
+      >>> result.stdout
+      '12\n'
+      >>> result.codes
+      [0, 0]
+
+    The pipes are connected directly, so no shell is started for commands
+    given as lists. result.code is the exit code of the last command, or
+    with ``pipefail`` of the last command that failed. The stderr of all
+    commands is collected together.
+    """
+    if not commands:
+        raise ValueError('pipeline requires at least one command')
+    pipefail = kwargs.pop('pipefail', False)
+    stages = [_run_options(command, kwargs) for command in commands]
+    options = obj(dict(stages[0].items()), grow=False)
+    options['command'] = u' | '.join([
+        stage.command if isinstance(stage.command, basestring_type) else
+        u' '.join([pipes.quote(arg) for arg in stage.command])
+        for stage in stages
+    ])
+    log.debug('pipeline: %s' % options.command)
+    return _run_process(_Process(options, stages=stages, pipefail=pipefail))
+
+
+def run_many(commands, concurrency=4, ordered=True, fail_fast=False, **kwargs):
+    """Run commands with at most ``concurrency`` of them running at a time
+    and yield their results, either in the order of commands or as they
+    complete when ``ordered`` is false.
+
+      >>> hosts = ['web1', 'web2', 'db1']
+      >>> for result in run_many(('ssh ${host} uptime', {'host': h}) for h in hosts):
+      ...     print(result.stdout)
+
+    Commands can be command strings or (command, kwargs) pairs, remaining
+    keyword arguments are passed to every command. With ``fail_fast`` no new
+    commands are started after one fails and the running ones are
+    terminated, along with any commands they started (each runs in its own
+    session). All output pipes are multiplexed in a single poll loop.
+    """
+    commands = enumerate(commands)
+    poller = _Poller()
+    owners = {}
+    running = []
+    finished = {}
+    state = {'next': 0, 'failed': False}
+
+    def start():
+        while not state['failed'] and len(running) < concurrency:
+            try:
+                index, command = next(commands)
+            except StopIteration:
+                return
+            options = kwargs
+            if isinstance(command, tuple) and len(command) == 2 and isinstance(command[1], dict):
+                command, extra = command
+                options = dict(kwargs)
+                options.update(extra)
+            options = _run_options(command, options)
+            log.debug('run_many: %s' % options.command)
+            process = _Process(options, session=True)
+            process.index = index
+            running.append(process)
+            process.register(poller)
+            for fd in process.open:
+                owners[fd] = process
+            if process.writing is not None:
+                owners[process.writing] = process
+
+    try:
+        start()
+        while running:
+            # processes which closed their pipes are checked until they exit
+            waiting = [p for p in running if not p.open]
+            timeouts = [p.timeout() for p in running]
+            timeouts = [t for t in timeouts if t is not None] + ([0.05] if waiting else [])
+            for fd in poller.poll(min(timeouts) if timeouts else None):
+                process = owners[fd]
+                if fd == process.writing:
+                    done = not process.write()
+                else:
+                    done = not process.read(fd)
+                if done:
+                    poller.unregister(fd)
+                    del owners[fd]
+            for process in list(running):
+                process.check()
+                if process.open or process.poll() is None:
+                    continue
+                if process.writing is not None:
+                    poller.unregister(process.writing)
+                    del owners[process.writing]
+                running.remove(process)
+                result = process.result()
+                if fail_fast and not result and not state['failed']:
+                    state['failed'] = True
+                    for other in running:
+                        other.signal(signal.SIGTERM)
+                if not ordered:
+                    yield result
+                    continue
+                finished[process.index] = result
+                while state['next'] in finished:
+                    yield finished.pop(state['next'])
+                    state['next'] += 1
+            start()
+    finally:
+        for process in running:
+            process.signal(signal.SIGTERM)
+            process.wait()
+            process.result()
+
+
+class _Process(object):
+    """A command started by run(), or the commands of a pipeline() connected
+    by pipes, along with their output pipes and timeout. With a timeout or
+    session each command runs in its own session, so signals reach the
+    commands it started as well."""
+
+    def __init__(self, options, keep=True, stages=None, pipefail=False, session=False):
+        self.options = options
+        self.pipefail = pipefail
+        self.timed_out = False
+        self.deadline = None
+        self.kill_at = None
+        self.session = session or options.timeout is not None
+        popen = {}
+        if options.timeout is not None:
+            self.deadline = time.time() + options.timeout
+        if self.session:
+            if py3:
+                popen['start_new_session'] = True
+            else:
+                popen['preexec_fn'] = os.setsid
+        self.refs = []
+        self.rusage = []
+        self.started = time.time()
+        self.finished = None
+        stdin = None if options.stdin is None else subprocess.PIPE
+        try:
+            for stage in stages or [options]:
+                ref = subprocess.Popen(
+                    stage.command,
+                    stdin=stdin,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT if options.combine else subprocess.PIPE,
+                    shell=stage.shell,
+                    close_fds=options.close_fds,
+                    env=options.env,
+                    cwd=options.cwd,
+                    **popen
+                )
+                if self.refs:
+                    # only the next command should hold the read end, so
+                    # that writers get SIGPIPE once it exits
+                    self.refs[-1].stdout.close()
+                self.refs.append(ref)
+                stdin = ref.stdout
+        except Exception:
+            for ref in self.refs:
+                ref.kill()
+                ref.wait()
+            raise
+        self.ref = self.refs[-1]
+        self.input = None
+        self.writing = None
+        if options.stdin is not None:
+            self.input = _Input(options.stdin)
+            self.writing = self.refs[0].stdin.fileno()
+            flags = fcntl.fcntl(self.writing, fcntl.F_GETFL)
+            fcntl.fcntl(self.writing, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.outputs = [(self.ref.stdout, _run_output(options, options.stdout, keep=keep))]
+        if not options.combine:
+            error = _run_output(options, options.stderr, keep=keep)
+            self.outputs.extend([(ref.stderr, error) for ref in self.refs])
+        self.open = dict((pipe.fileno(), output) for pipe, output in self.outputs)
+
+    def register(self, poller):
+        """Register the pipes of the process with poller."""
+        for fd in self.open:
+            poller.register(fd)
+        if self.writing is not None:
+            poller.register(self.writing, write=True)
+
+    def read(self, fd):
+        """Read and return a chunk from fd, which is empty once it's
+        closed."""
+        data = self.open[fd].read(fd)
+        if not data:
+            del self.open[fd]
+        return data
+
+    def write(self):
+        """Write some input to stdin, returns False once it's closed."""
+        if self.input.write(self.writing):
+            return True
+        self.close_stdin()
+        return False
+
+    def close_stdin(self):
+        if self.writing is not None:
+            self.writing = None
+            try:
+                self.refs[0].stdin.close()
+            except (IOError, OSError):
+                pass
+
+    def signal(self, sig):
+        """Send sig to the processes, or their process groups if they have
+        one."""
+        for ref in self.refs:
+            try:
+                if self.session:
+                    os.killpg(ref.pid, sig)
+                else:
+                    ref.send_signal(sig)
+            except OSError:
+                pass
+
+    def reap(self, ref, block=False):
+        """Return the exit code of ref, or None if it's still running. Exited
+        processes are reaped with os.wait4 to collect their resource usage."""
+        if ref.returncode is not None:
+            return ref.returncode
+        if not hasattr(os, 'wait4'):
+            return ref.wait() if block else ref.poll()
+        try:
+            pid, status, usage = os.wait4(ref.pid, 0 if block else os.WNOHANG)
+        except OSError as error:
+            if error.errno == errno.EINTR:
+                return self.reap(ref, block)
+            if error.errno != errno.ECHILD:
+                raise
+            return ref.wait() if block else ref.poll()
+        if pid == 0:
+            return None
+        if os.WIFSIGNALED(status):
+            ref.returncode = -os.WTERMSIG(status)
+        else:
+            ref.returncode = os.WEXITSTATUS(status)
+        self.rusage.append(usage)
+        if all([r.returncode is not None for r in self.refs]):
+            self.finished = time.time()
+        return ref.returncode
+
+    def poll(self):
+        """Return the exit code once every process has exited, otherwise
+        None."""
+        if any([self.reap(ref) is None for ref in self.refs]):
+            return None
+        return self.ref.returncode
+
+    def timeout(self):
+        """Return the number of seconds until the next timeout action."""
+        if self.kill_at is not None:
+            return max(self.kill_at - time.time(), 0)
+        elif self.deadline is not None and not self.timed_out:
+            return max(self.deadline - time.time(), 0)
+
+    def check(self):
+        """Terminate or kill the process when its time is up."""
+        if self.deadline is None:
+            return
+        now = time.time()
+        if not self.timed_out and now >= self.deadline:
+            log.debug('run: timed out: %s' % self.options.command)
+            self.timed_out = True
+            self.kill_at = now + self.options.kill_grace
+            self.signal(signal.SIGTERM)
+        elif self.kill_at is not None and now >= self.kill_at:
+            self.kill_at = None
+            self.signal(signal.SIGKILL)
+
+    def wait(self):
+        """Wait for the processes to exit, enforcing the timeout."""
+        while self.poll() is None:
+            timeout = self.timeout()
+            if timeout is None:
+                for ref in self.refs:
+                    self.reap(ref, block=True)
+                break
+            time.sleep(min(timeout, 0.05))
+            self.check()
+
+    def result(self):
+        self.close_stdin()
+        for pipe, output in self.outputs:
+            pipe.close()
+        codes = [ref.returncode for ref in self.refs]
+        code = codes[-1]
+        if self.pipefail:
+            code = ([c for c in codes if c != 0] or [0])[-1]
+        result = _run_result(
+            self.options.command,
+            code,
+            self.outputs[0][1].getvalue(),
+            self.outputs[1][1].getvalue() if not self.options.combine else b'',
+            timed_out=self.timed_out,
+            duration=(self.finished or time.time()) - self.started,
+            rusage=_run_rusage(self.rusage),
+        )
+        if len(codes) > 1:
+            result['codes'] = codes
+        if self.options.metrics:
+            self.options.metrics(result)
+        return result
+
+
+class run_stream(object):
+    """Run a command and iterate over its output as it arrives, without
+    keeping it in memory. Takes the same arguments as run() and yields
+    (name, chunk) tuples, where name is ``stdout`` or ``stderr``.
+
+      >>> stream = run_stream('journalctl -u ${unit}', unit='nginx', lines=True)
+      >>> for name, line in stream:
+      ...     if b'error' in line:
+      ...         print(line)
+      >>> stream.code
+      0
+
+    With ``lines`` complete lines are yielded instead of chunks. The
+    ``code``, ``timed_out``, ``duration`` and ``rusage`` attributes are set
+    once the iterator is exhausted, and the command (along with the
+    commands it started, as it runs in its own session) is terminated if
+    iteration stops early.
+    """
+
+    def __init__(self, command, lines=False, **kwargs):
+        self.options = _run_options(command, kwargs)
+        self.command = self.options.command
+        self.lines = lines
+        self.code = None
+        self.timed_out = False
+        self.duration = None
+        self.rusage = None
+
+    def __bool__(self):
+        return self.code == 0
+
+    def __nonzero__(self):
+        return self.__bool__()
+
+    def __iter__(self):
+        log.debug('run_stream: %s' % self.command)
+        process = _Process(self.options, keep=False, session=True)
+        names = {}
+        buffers = {}
+        for pipe, output in process.outputs:
+            names[pipe.fileno()] = 'stdout' if pipe is process.ref.stdout else 'stderr'
+            buffers[pipe.fileno()] = b''
+        poller = _Poller()
+        process.register(poller)
+        try:
+            while poller:
+                for fd in poller.poll(process.timeout()):
+                    if fd == process.writing:
+                        if not process.write():
+                            poller.unregister(fd)
+                        continue
+                    data = process.read(fd)
+                    if not data:
+                        poller.unregister(fd)
+                        if buffers[fd]:
+                            yield names[fd], buffers[fd]
+                    elif not self.lines:
+                        yield names[fd], data
+                    else:
+                        lines = (buffers[fd] + data).split(b'\n')
+                        buffers[fd] = lines.pop()
+                        for line in lines:
+                            yield names[fd], line + b'\n'
+                process.check()
+            process.wait()
+        finally:
+            if poller or process.poll() is None:
+                process.signal(signal.SIGTERM)
+                process.wait()
+            result = process.result()
+            self.code = result.code
+            self.timed_out = result.timed_out
+            self.duration = result.duration
+            self.rusage = result.rusage
+
+
+class _AsyncRun(object):
+    """An asyncio subprocess protocol which resolves future with a run()
+    result once the process has exited and its output pipes are closed.
+
+    Streamed stdin is read a chunk at a time in the loop's executor, since
+    files and iterators can block, and reading pauses while the stdin
+    transport's write buffer is full. Once the process is done the input is
+    closed, by the executor thread if it's still reading a chunk."""
+
+    def __init__(self, future, options, loop):
+        self.future = future
+        self.options = options
+        self.loop = loop
+        self.started = time.time()
+        self.transport = None
+        self.exited = False
+        self.timed_out = False
+        self.timer = None
+        self.error = None
+        self.stdin = None
+        self.chunks = None
+        self.read = None
+        self.reading = False
+        self.paused = False
+        # guards busy and closed, which are shared with the executor thread
+        self.lock = threading.Lock()
+        self.busy = False
+        self.closed = False
+        self.outputs = {1: _run_output(options, options.stdout)}
+        if not options.combine:
+            self.outputs[2] = _run_output(options, options.stderr)
+        self.open = set(self.outputs)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.options.timeout is not None:
+            self.timer = self.loop.call_later(self.options.timeout, self._timeout)
+        if self.options.stdin is not None:
+            self.stdin = transport.get_pipe_transport(0)
+            if isinstance(self.options.stdin, bytes_type):
+                self.stdin.write(self.options.stdin)
+                self._close_stdin()
+            else:
+                self.chunks = iter(_Input(self.options.stdin))
+                self._read()
+
+    def _read(self):
+        if self.stdin is None or self.reading or self.paused or self.closed:
+            return
+        self.reading = True
+        self.busy = True
+        self.read = self.loop.run_in_executor(None, self._next)
+        self.read.add_done_callback(self._write)
+
+    def _next(self):
+        # runs in the executor
+        try:
+            chunk = next(self.chunks, None)
+        finally:
+            with self.lock:
+                self.busy = False
+                closed = self.closed
+        if closed:
+            self._close_chunks()
+            return None
+        return chunk
+
+    def _close_chunks(self):
+        close = getattr(self.chunks, 'close', None)
+        if close is not None:
+            close()
+
+    def _write(self, read):
+        self.reading = False
+        self.read = None
+        if self.stdin is None or self.closed:
+            return
+        error = None if read.cancelled() else read.exception()
+        if error is not None:
+            self.error = error
+        elif not read.cancelled() and read.result() is not None:
+            self.stdin.write(read.result())
+            self._read()
+            return
+        self._close_stdin()
+
+    def _close_stdin(self):
+        if self.stdin is not None:
+            self.stdin.close()
+            self.stdin = None
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self._read()
+
+    def pipe_data_received(self, fd, data):
+        self.outputs[fd].feed(data)
+
+    def pipe_connection_lost(self, fd, exc):
+        if fd == 0:
+            self.stdin = None
+        if fd in self.open:
+            self.open.remove(fd)
+            self.outputs[fd].feed(b'')
+        self._done()
+
+    def process_exited(self):
+        self.exited = True
+        self._done()
+
+    def connection_lost(self, exc):
+        pass
+
+    def _signal(self, sig):
+        try:
+            os.killpg(self.transport.get_pid(), sig)
+        except OSError:
+            pass
+
+    def _timeout(self):
+        log.debug('run_async: timed out: %s' % self.options.command)
+        self.timed_out = True
+        self.timer = self.loop.call_later(self.options.kill_grace, self._kill)
+        self._signal(signal.SIGTERM)
+
+    def _kill(self):
+        self.timer = None
+        self._signal(signal.SIGKILL)
+
+    def _done(self):
+        if not self.exited or self.open or self.future.done():
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.chunks is not None:
+            with self.lock:
+                self.closed = True
+                busy = self.busy
+            if not busy:
+                self._close_chunks()
+            if self.read is not None:
+                # drops the chunk being read, even once the loop is closed
+                self.read.cancel()
+        code = self.transport.get_returncode()
+        self.transport.close()
+        if self.error is not None:
+            self.future.set_exception(self.error)
+            return
+        result = _run_result(
+            self.options.command,
+            code,
+            self.outputs[1].getvalue(),
+            self.outputs[2].getvalue() if 2 in self.outputs else b'',
+            timed_out=self.timed_out,
+            duration=time.time() - self.started,
+        )
+        if self.options.metrics:
+            self.options.metrics(result)
+        self.future.set_result(result)
+
+
+def run_async(command, **kwargs):
+    """Run a shell command with asyncio, taking the same arguments as run().
+    Returns a future which resolves to the same result object.
+
+      >>> results = loop.run_until_complete(asyncio.gather(
+      ...     run_async('systemctl is-active ${name}', name='nginx'),
+      ...     run_async('systemctl is-active ${name}', name='redis'),
+      ... ))
+      >>> [result.code for result in results]
+      [0, 3]
+
+    The event loop can be set with ``loop``, it defaults to the current event
+    loop. The event loop reaps the process, so result.rusage is None.
+    ``timeout`` and ``kill_grace`` are handled with timers on the event loop
+    in the same way as run().
+    """
+    if asyncio is None:
+        raise Error('run_async requires asyncio')
+    loop = kwargs.pop('loop', None) or asyncio.get_event_loop()
+    options = _run_options(command, kwargs)
+    log.debug('run_async: %s' % options.command)
+    future = loop.create_future() if hasattr(loop, 'create_future') else asyncio.Future(loop=loop)
+    factory = lambda: _AsyncRun(future, options, loop)
+    popen = {
+        'stdin': None if options.stdin is None else subprocess.PIPE,
+        'stdout': subprocess.PIPE,
+        'stderr': subprocess.STDOUT if options.combine else subprocess.PIPE,
+        'close_fds': options.close_fds,
+        'env': options.env,
+        'cwd': options.cwd,
+    }
+    if options.timeout is not None:
+        if py3:
+            popen['start_new_session'] = True
+        else:
+            popen['preexec_fn'] = os.setsid
+    if options.shell:
+        start = loop.subprocess_shell(factory, options.command, **popen)
+    else:
+        command = options.command
+        if isinstance(command, basestring_type):
+            command = [command]
+        start = loop.subprocess_exec(factory, *command, **popen)
+
+    def started(task):
+        if not task.cancelled() and task.exception() is not None and not future.done():
+            future.set_exception(task.exception())
+
+    ensure_future = getattr(asyncio, 'ensure_future', None) or getattr(asyncio, 'async')
+    ensure_future(start, loop=loop).add_done_callback(started)
+    return future
+
+
+class _SessionStream(object):
+    """Pass the output of a session command to output until the marker
+    which ends it, keeping back data which could be the start of the
+    marker."""
+
+    def __init__(self, output, marker):
+        self.output = output
+        self.marker = marker
+        self.pending = b''
+        self.tail = None
+
+    def feed(self, data):
+        if self.tail is not None:
+            self.tail += data
+            return
+        data = self.pending + data
+        index = data.find(self.marker)
+        if index >= 0:
+            self.output.feed(data[:index])
+            self.output.feed(b'')
+            self.pending = b''
+            self.tail = data[index + len(self.marker):]
+        else:
+            split = max(len(data) - len(self.marker) + 1, 0)
+            self.output.feed(data[:split])
+            self.pending = data[split:]
+
+    def close(self):
+        """Flush the output when the shell exited before the marker."""
+        if self.tail is None:
+            self.output.feed(self.pending)
+            self.output.feed(b'')
+            self.pending = b''
+            self.tail = b''
+
+
+class session(object):
+    """Run commands through a single long running shell, which avoids
+    starting a new shell for every command.
+
+      >>> with session() as s:
+      ...     for name in ('nginx', 'redis'):
+      ...         print(s.run('systemctl is-active ${name}', name=name).code)
+      0
+      3
+
+    run() takes the same arguments as the run() function (except env and
+    cwd, which are set for the whole session) and returns the same result
+    object. Commands run in the shell itself, so changes to the working
+    directory and variables persist between them. If a command exits the
+    shell or times out a new shell is started for the next command.
+    Sessions aren't thread safe.
+    """
+
+    def __init__(self, shell='/bin/sh', **kwargs):
+        self.shell = shell
+        self.options = _run_options('', kwargs)
+        self.ref = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def start(self):
+        """Start the shell, unless it's already running."""
+        if self.ref is not None and self.ref.poll() is not None:
+            self.close()
+        if self.ref is not None:
+            return
+        popen = {}
+        if py3:
+            popen['start_new_session'] = True
+        else:
+            popen['preexec_fn'] = os.setsid
+        self.ref = subprocess.Popen(
+            [self.shell],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=self.options.close_fds,
+            env=self.options.env,
+            cwd=self.options.cwd,
+            **popen
+        )
+
+    def close(self):
+        """Stop the shell."""
+        if self.ref is None:
+            return
+        ref, self.ref = self.ref, None
+        try:
+            ref.stdin.close()
+        except (IOError, OSError):
+            pass
+        ref.stdout.close()
+        ref.stderr.close()
+        ref.wait()
+
+    def signal(self, sig):
+        """Send sig to the shell and the commands it started."""
+        try:
+            os.killpg(self.ref.pid, sig)
+        except OSError:
+            pass
+
+    def run(self, command, **kwargs):
+        """Run a command in the session and wait for the result."""
+        if 'env' in kwargs or 'cwd' in kwargs:
+            raise ValueError('env and cwd are set on the session')
+        options = _run_options(command, kwargs)
+        command = options.command
+        if not isinstance(command, basestring_type):
+            command = u' '.join([pipes.quote(arg) for arg in command])
+        log.debug('session: %s' % command)
+        self.start()
+        token = uuid.uuid4().hex
+        stdin = '/dev/null'
+        if options.stdin is not None:
+            with tempfile.NamedTemporaryFile(prefix='ops-session-', delete=False) as f:
+                for chunk in _Input(options.stdin):
+                    f.write(chunk)
+            stdin = f.name
+        # the exit code and the end of stderr are marked with the token
+        script = u'\n'.join([
+            u'{ eval %s' % pipes.quote(command),
+            u'} <%s%s' % (pipes.quote(stdin), u' 2>&1' if options.combine else u''),
+            u"printf '\\n%s:%%d\\n' \"$?\"" % token,
+            u"printf '\\n%s\\n' >&2" % token,
+            u'',
+        ])
+        out = _SessionStream(_run_output(options, options.stdout), ('\n%s:' % token).encode('ascii'))
+        err = _SessionStream(_run_output(options, options.stderr), ('\n%s\n' % token).encode('ascii'))
+        streams = {self.ref.stdout.fileno(): out, self.ref.stderr.fileno(): err}
+        started = time.time()
+        deadline = None if options.timeout is None else started + options.timeout
+        timed_out = False
+        kill_at = None
+        try:
+            self.ref.stdin.write(script.encode('utf-8'))
+            self.ref.stdin.flush()
+            poller = _Poller()
+            for fd in streams:
+                poller.register(fd)
+            while poller:
+                timeout = None
+                if kill_at is not None:
+                    timeout = max(kill_at - time.time(), 0)
+                elif deadline is not None:
+                    timeout = max(deadline - time.time(), 0)
+                for fd in poller.poll(timeout):
+                    data = os.read(fd, _Output.size)
+                    if data:
+                        streams[fd].feed(data)
+                    else:
+                        poller.unregister(fd)
+                if err.tail is not None and out.tail is not None and b'\n' in out.tail:
+                    break
+                now = time.time()
+                if not timed_out and deadline is not None and now >= deadline:
+                    log.debug('session: timed out: %s' % command)
+                    timed_out = True
+                    kill_at = now + options.kill_grace
+                    self.signal(signal.SIGTERM)
+                elif kill_at is not None and now >= kill_at:
+                    kill_at = None
+                    self.signal(signal.SIGKILL)
+        finally:
+            if stdin != '/dev/null':
+                os.remove(stdin)
+        if out.tail is not None and b'\n' in out.tail:
+            code = int(out.tail.split(b'\n')[0])
+        else:
+            # the shell exited (or was killed), the next command gets a new one
+            for stream in streams.values():
+                stream.close()
+            ref = self.ref
+            self.close()
+            code = ref.returncode
+        result = _run_result(
+            command,
+            code,
+            out.output.getvalue(),
+            err.output.getvalue() if not options.combine else b'',
+            timed_out=timed_out,
+            duration=time.time() - started,
+        )
+        if options.metrics:
+            options.metrics(result)
+        return result
 
 
 class stat(object):
@@ -965,7 +3550,11 @@ class stat(object):
     @property
     def data(self):
         if not hasattr(self, '_data'):
-            self._data = os.stat(self.path)
+            entry = getattr(self, '_entry', None)
+            if entry is not None:
+                self._data = entry.stat()
+            else:
+                self._data = os.stat(self.path)
         return self._data
 
     @property
@@ -1048,21 +3637,204 @@ class stat(object):
     def ctime(self):
         return datetime.datetime.fromtimestamp(self.data[9])
 
+    def _is_type(self, name, test):
+        entry = getattr(self, '_entry', None)
+        if entry is not None:
+            return getattr(entry, 'is_%s' % name)()
+        elif hasattr(self, '_data'):
+            return test(self._data[0])
+        return getattr(os.path, 'is%s' % name)(self.path)
+
+    @property
+    def link(self):
+        if not hasattr(self, '_link'):
+            entry = getattr(self, '_entry', None)
+            if entry is not None:
+                self._link = entry.is_symlink()
+            else:
+                self._link = os.path.islink(self.path)
+        return self._link
+
     @property
     def file(self):
         if not hasattr(self, '_file'):
-            self._file = os.path.isfile(self.path)
+            self._file = self._is_type('file', stat_.S_ISREG)
         return self._file
 
     @property
     def directory(self):
         if not hasattr(self, '_directory'):
-            self._directory = os.path.isdir(self.path)
+            self._directory = self._is_type('dir', stat_.S_ISDIR)
         return self._directory
 
 _ops_stat = stat
 
 
+def _sync_scan(top):
+    """Return a dict of paths relative to top and their lstat results, along
+    with the relative paths in top down order. A missing top is empty."""
+    entries = {}
+    order = []
+    if not os.path.isdir(top):
+        return entries, order
+    dirs = ['']
+    while dirs:
+        rel = dirs.pop()
+        for e in _listdir(os.path.join(top, rel)):
+            name = os.path.join(rel, e.name)
+            st = e.stat(follow_symlinks=False)
+            entries[name] = st
+            order.append(name)
+            if stat_.S_ISDIR(st.st_mode):
+                dirs.append(name)
+    return entries, order
+
+
+def _sync_remove(path):
+    """Remove path, returning False if it was already gone."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+    else:
+        return False
+    return True
+
+
+def _sync_replace(src, dst, st):
+    """Copy the file or symlink src to a temporary file next to dst and
+    rename it into place."""
+    root, name = os.path.split(dst)
+    fd, tmp = tempfile.mkstemp(prefix='.%s.' % name, suffix='.tmp', dir=root)
+    os.close(fd)
+    try:
+        if stat_.S_ISLNK(st.st_mode):
+            os.unlink(tmp)
+            os.symlink(os.readlink(src), tmp)
+        else:
+            _copy_file(src, tmp)
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        os.rename(tmp, dst)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def sync(src_path, dst_path, delete=False, checksum=False, workers=1):
+    """Make dst_path a copy of the src_path directory, only copying what
+    changed, and return a summary of the paths (relative to dst_path) that
+    were ``copied`` and ``deleted``, the number ``unchanged`` and the
+    ``failed`` (path, error) tuples. The summary is False if anything
+    failed.
+
+      >>> result = sync('/srv/build', '/srv/www', delete=True)
+      >>> result.copied
+      ['index.html', 'static/app.js']
+      >>> result.unchanged
+      1832
+
+    Files are compared by size and mtime (in seconds), or by content with
+    ``checksum``. Changed files and symlinks are written to a temporary
+    file which is renamed into place, so readers never see a partial file.
+    With ``delete`` paths which don't exist in src_path are removed. Files
+    are copied by up to ``workers`` threads.
+    """
+    copied = []
+    deleted = []
+    failed = []
+    unchanged = 0
+
+    def summary():
+        return obj({
+            'copied': copied,
+            'deleted': deleted,
+            'unchanged': unchanged,
+            'failed': failed,
+        }, bool=not failed, grow=False)
+
+    try:
+        if not os.path.isdir(src_path):
+            raise OSError(errno.ENOTDIR, 'source is not a directory')
+        src, order = _sync_scan(src_path)
+        dst = _sync_scan(dst_path)[0]
+        if not os.path.isdir(dst_path):
+            os.makedirs(dst_path)
+    except OSError as error:
+        log.error('sync: execute failed: %s => %s (%s)' % (src_path, dst_path, error))
+        failed.append(('', error))
+        return summary()
+    changes = []
+    for name in order:
+        st = src[name]
+        path = os.path.join(dst_path, name)
+        current = dst.get(name)
+        try:
+            if stat_.S_ISDIR(st.st_mode):
+                if current is None or not stat_.S_ISDIR(current.st_mode):
+                    if current is not None:
+                        os.unlink(path)
+                    os.mkdir(path)
+                continue
+            if not stat_.S_ISREG(st.st_mode) and not stat_.S_ISLNK(st.st_mode):
+                raise Error('special file')
+            changed = True
+            if current is not None and stat_.S_IFMT(current.st_mode) == stat_.S_IFMT(st.st_mode):
+                if stat_.S_ISLNK(st.st_mode):
+                    changed = os.readlink(os.path.join(src_path, name)) != os.readlink(path)
+                elif current.st_size != st.st_size:
+                    changed = True
+                elif checksum:
+                    changed = _hash_file(os.path.join(src_path, name)) != _hash_file(path)
+                else:
+                    changed = int(current.st_mtime) != int(st.st_mtime)
+        except (IOError, OSError, Error) as error:
+            failed.append((name, error))
+            continue
+        if changed:
+            changes.append(name)
+        else:
+            unchanged += 1
+
+    def transfer(name):
+        try:
+            _sync_replace(os.path.join(src_path, name), os.path.join(dst_path, name), src[name])
+        except (IOError, OSError, Error) as error:
+            return error
+
+    for name, error in zip(changes, _map(transfer, changes, workers)):
+        if error is None:
+            copied.append(name)
+        else:
+            failed.append((name, error))
+    if delete:
+        removed = set()
+        # parents sort before their children
+        for name in sorted(dst):
+            if name in src:
+                continue
+            if os.path.dirname(name) in removed:
+                removed.add(name)
+                continue
+            try:
+                if _sync_remove(os.path.join(dst_path, name)):
+                    deleted.append(name)
+                removed.add(name)
+            except OSError as error:
+                failed.append((name, error))
+    for name in reversed([''] + order):
+        if name and not stat_.S_ISDIR(src[name].st_mode):
+            continue
+        try:
+            shutil.copystat(os.path.join(src_path, name), os.path.join(dst_path, name))
+        except OSError as error:
+            failed.append((name, error))
+    for name, error in failed:
+        log.error('sync: copy failed: %s (%s)' % (os.path.join(src_path, name), error))
+    return summary()
+
+
 class user(object):
     """Get information about a user.
 
@@ -1200,6 +3972,8 @@ __all__ = [
     'chmod',
     'chown',
     'cp',
+    'du',
+    'duplicates',
     'env',
     'exit',
     'find',
@@ -1210,9 +3984,16 @@ __all__ = [
     'obj',
     'path',
     'perm',
+    'pipeline',
     'rm',
     'run',
+    'run_async',
+    'run_cache',
+    'run_many',
+    'run_stream',
+    'session',
     'stat',
+    'sync',
     'user',
     'workspace',
 ]
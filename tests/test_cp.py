@@ -89,6 +89,96 @@ class CpTestCase(unittest.TestCase):
         path2 = os.path.join(dir_path, self.name1)
         self.check_same_file(self.path1, path2)
 
+    def test_copy_methods(self):
+        src = self.workspace.join('src')
+        data = os.urandom(3 * 1024 * 1024 + 17)
+        with open(src, 'wb') as f:
+            f.write(data)
+        os.chmod(src, 0o640)
+        for method in ops._COPY_METHODS:
+            dst = self.workspace.join(method)
+            ops._copy_file(src, dst, methods=(method, 'read'))
+            with open(dst, 'rb') as f:
+                self.assertEqual(f.read(), data)
+            self.check_stat(src, dst)
+
+    def test_copy_empty(self):
+        dst = self.workspace.join('dst')
+        self.assertTrue(ops.cp('/proc/self/status', dst))
+        with open(dst, 'rb') as f:
+            self.assertTrue(f.read().startswith(b'Name:'))
+
+    def test_pseudo_file(self):
+        src = '/sys/devices/system/cpu/online'
+        if not os.path.exists(src):
+            self.skipTest('no sysfs')
+        with open(src, 'rb') as f:
+            content = f.read()
+        for sparse in ('auto', 'always', 'never'):
+            dst = self.workspace.join(sparse)
+            self.assertTrue(ops.cp(src, dst, sparse=sparse))
+            with open(dst, 'rb') as f:
+                self.assertEqual(f.read(), content)
+
+    def test_extents_short(self):
+        # a file which is shorter than the size it had when it was opened
+        src = self.workspace.join('src')
+        with open(src, 'wb') as f:
+            f.write(b'short')
+        dst = self.workspace.join('dst')
+        with open(src, 'rb') as f1:
+            with open(dst, 'wb') as f2:
+                ops._copy_extents(f1.fileno(), f2.fileno(), 4096)
+        with open(dst, 'rb') as f:
+            self.assertEqual(f.read(), b'short')
+
+    def write_sparse(self, path, size=16 * 1024 * 1024):
+        with open(path, 'wb') as f:
+            f.write(b'start')
+            f.seek(size // 2)
+            f.write(b'middle')
+            f.truncate(size)
+
+    def check_content(self, path1, path2):
+        with open(path1, 'rb') as f1:
+            with open(path2, 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def allocated(self, path):
+        return os.stat(path).st_blocks * 512
+
+    def test_sparse(self):
+        src = self.workspace.join('src')
+        self.write_sparse(src)
+        if self.allocated(src) >= 1024 * 1024:
+            self.skipTest('filesystem does not support sparse files')
+        auto = self.workspace.join('auto')
+        never = self.workspace.join('never')
+        self.assertTrue(ops.cp(src, auto))
+        self.assertTrue(ops.cp(src, never, sparse='never'))
+        for path in (auto, never):
+            self.check_content(src, path)
+            self.assertEqual(os.path.getsize(path), 16 * 1024 * 1024)
+        self.assertTrue(self.allocated(auto) < 1024 * 1024)
+        self.assertTrue(self.allocated(never) >= 16 * 1024 * 1024)
+        self.assertFalse(ops.cp(src, self.workspace.join('invalid'), sparse='yes'))
+
+    def test_sparse_always(self):
+        src = self.workspace.join('src')
+        with open(src, 'wb') as f:
+            f.write(b'\0' * 4 * 1024 * 1024 + b'end')
+        dst = self.workspace.join('dst')
+        self.assertTrue(ops.cp(src, dst, sparse='always'))
+        self.check_content(src, dst)
+        self.assertTrue(self.allocated(dst) < 1024 * 1024)
+
+    def test_sparse_tree(self):
+        os.makedirs(self.workspace.join('src'))
+        self.write_sparse(self.workspace.join('src', 'image'))
+        self.assertTrue(ops.cp(self.workspace.join('src'), self.workspace.join('dst'), workers=2))
+        self.check_content(self.workspace.join('src', 'image'), self.workspace.join('dst', 'image'))
+        self.assertTrue(self.allocated(self.workspace.join('dst', 'image')) < 1024 * 1024)
+
     def test_error(self):
         # src path doesn't exist
         self.assertFalse(ops.cp('/tmp/ops-cp-error', '/tmp/ops-cp'))
@@ -96,6 +186,25 @@ class CpTestCase(unittest.TestCase):
         # invalid src or dst path
         ops.cp(True, False)
 
+    def test_no_copy_method(self):
+        self.setup_file()
+        copy_data = ops._copy_data
+
+        def broken(*args, **kwargs):
+            raise ops.Error('no copy method')
+
+        ops._copy_data = broken
+        try:
+            self.assertFalse(ops.cp(self.path1, self.path2))
+        finally:
+            ops._copy_data = copy_data
+
+    def test_fifo(self):
+        src = self.workspace.join('fifo')
+        os.mkfifo(src)
+        self.assertFalse(ops.cp(src, self.workspace.join('dst')))
+        self.assertFalse(os.path.exists(self.workspace.join('dst')))
+
     def test_directory(self):
         self.setup_directory()
         ops.cp(self.path1, self.path2)
@@ -103,6 +212,53 @@ class CpTestCase(unittest.TestCase):
         self.check_same_file(self.src_file_path2, self.dst_file_path2)
         self.check_stat(self.path1, self.path2)
 
+    def setup_tree(self):
+        self.path1 = self.workspace.join('src')
+        self.path2 = self.workspace.join('dst')
+        for n in range(5):
+            os.makedirs(os.path.join(self.path1, 'dir%s' % n, 'sub'))
+            for m in range(20):
+                with open(os.path.join(self.path1, 'dir%s' % n, 'sub', 'file%s' % m), 'w') as f:
+                    f.write('%s %s' % (n, m))
+        os.link(os.path.join(self.path1, 'dir0', 'sub', 'file0'), os.path.join(self.path1, 'hardlink'))
+        os.symlink(os.path.join('dir1', 'sub', 'file1'), os.path.join(self.path1, 'symlink'))
+        for root, dirs, files in os.walk(self.path1):
+            os.utime(root, (1000000000, 1000000000))
+
+    def test_tree(self):
+        self.setup_tree()
+        self.assertTrue(ops.cp(self.path1, self.path2, workers=4))
+        for n in range(5):
+            for m in range(20):
+                name = os.path.join('dir%s' % n, 'sub', 'file%s' % m)
+                with open(os.path.join(self.path2, name)) as f:
+                    self.assertEqual(f.read(), '%s %s' % (n, m))
+                stat1 = os.stat(os.path.join(self.path1, name))
+                stat2 = os.stat(os.path.join(self.path2, name))
+                self.assertEqual(stat1.st_mode, stat2.st_mode)
+                self.assertAlmostEqual(stat1.st_mtime, stat2.st_mtime, places=3)
+        for root, dirs, files in os.walk(self.path2):
+            self.assertEqual(os.stat(root).st_mtime, 1000000000)
+        self.assertEqual(os.stat(os.path.join(self.path2, 'hardlink')).st_ino,
+                         os.stat(os.path.join(self.path2, 'dir0', 'sub', 'file0')).st_ino)
+        self.assertFalse(os.path.islink(os.path.join(self.path2, 'symlink')))
+        with open(os.path.join(self.path2, 'symlink')) as f:
+            self.assertEqual(f.read(), '1 1')
+
+    def test_tree_links(self):
+        self.setup_tree()
+        self.assertTrue(ops.cp(self.path1, self.path2, follow_links=True, workers=4))
+        self.assertEqual(os.readlink(os.path.join(self.path2, 'symlink')), os.path.join('dir1', 'sub', 'file1'))
+
+    def test_tree_failures(self):
+        self.setup_tree()
+        os.mkfifo(os.path.join(self.path1, 'dir2', 'fifo'))
+        self.assertFalse(ops.cp(self.path1, self.path2, workers=4))
+        self.assertFalse(os.path.exists(os.path.join(self.path2, 'dir2', 'fifo')))
+        self.assertTrue(os.path.exists(os.path.join(self.path2, 'dir4', 'sub', 'file19')))
+        # the destination must not exist
+        self.assertFalse(ops.cp(self.path1, self.path2))
+
     def test_recursive(self):
         self.setup_directory()
         path = self.workspace.join('dst')
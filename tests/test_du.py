@@ -0,0 +1,79 @@
+from __future__ import unicode_literals
+
+import helper
+
+import os
+import unittest
+
+import ops
+
+
+class DuTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = helper.Workspace()
+        for n1 in range(0, 2):
+            for n2 in range(0, 2):
+                p = self.workspace.join('dir%s' % n1, 'dir%s' % n2)
+                os.makedirs(p)
+                with open(os.path.join(p, 'file.txt'), 'w') as f:
+                    f.write('hello world')
+        with open(self.workspace.join('file.log'), 'w') as f:
+            f.write('hello')
+        os.link(self.workspace.join('file.log'), self.workspace.join('dir0', 'link.log'))
+
+    def tearDown(self):
+        self.workspace.destroy()
+
+    def test_dir(self):
+        usage = ops.du(self.workspace.path)
+        self.assertEqual(len(usage), 7)
+        total = usage[self.workspace.path]
+        self.assertEqual(total.count, 12)
+        dir_size = sum(os.lstat(p).st_size for p in ops.find(self.workspace.path).filter(directory=True))
+        self.assertEqual(total.size, dir_size + 4 * 11 + 5)
+        self.assertTrue(total.allocated > 0)
+        sub = usage[self.workspace.join('dir1', 'dir0')]
+        self.assertEqual(sub.count, 2)
+        self.assertEqual(sub.size, os.lstat(self.workspace.join('dir1', 'dir0')).st_size + 11)
+
+    def test_depth(self):
+        usage = ops.du(self.workspace.path, depth=1)
+        self.assertEqual(sorted(usage), [
+            self.workspace.path,
+            self.workspace.join('dir0'),
+            self.workspace.join('dir1'),
+        ])
+        self.assertEqual(usage[self.workspace.join('dir1')].count, 5)
+        self.assertEqual(usage[self.workspace.path].count, 12)
+        usage = ops.du(self.workspace.path, depth=0)
+        self.assertEqual(list(usage), [self.workspace.path])
+        self.assertEqual(usage[self.workspace.path].count, 12)
+
+    def test_user(self):
+        usage = ops.du(self.workspace.path, by='user')
+        self.assertEqual(list(usage), [os.geteuid()])
+        self.assertEqual(usage[os.geteuid()].count, 12)
+
+    def test_ext(self):
+        usage = ops.du(self.workspace.path, by='ext')
+        self.assertEqual(usage['.txt'].count, 4)
+        self.assertEqual(usage['.txt'].size, 44)
+        self.assertEqual(usage['.log'].count, 1)
+        self.assertEqual(usage[''].count, 7)
+
+    def test_file(self):
+        path = self.workspace.join('file.log')
+        usage = ops.du(path)
+        self.assertEqual(list(usage), [path])
+        self.assertEqual(usage[path].count, 1)
+        self.assertEqual(usage[path].size, 5)
+        self.assertEqual(ops.du(path, by='user')[os.geteuid()].size, 5)
+        self.assertEqual(ops.du(path, by='ext')['.log'].count, 1)
+
+    def test_error(self):
+        self.assertFalse(ops.du(self.workspace.join('missing')))
+        self.assertFalse(ops.du(self.workspace.path, by='unknown'))
+
+if __name__ == '__main__':
+    unittest.main()
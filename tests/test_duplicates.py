@@ -0,0 +1,57 @@
+from __future__ import unicode_literals
+
+import helper
+
+import os
+import unittest
+
+import ops
+
+
+class DuplicatesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = helper.Workspace()
+        big = b'a' * 100000 + b'b' * 100000 + b'c' * 100000
+        self.write('small1', b'hello world')
+        self.write('small2', b'hello world')
+        self.write('small3', b'hello there')
+        self.write('empty1', b'')
+        self.write('empty2', b'')
+        self.write('big1', big)
+        self.write('big2', big)
+        self.write('big3', big[:150000] + b'x' + big[150001:])
+        os.link(self.workspace.join('small1'), self.workspace.join('link'))
+
+    def tearDown(self):
+        self.workspace.destroy()
+
+    def write(self, name, content):
+        with open(self.workspace.join(name), 'wb') as f:
+            f.write(content)
+
+    def names(self, groups):
+        return sorted(sorted(os.path.basename(p) for p in g) for g in groups)
+
+    def test_duplicates(self):
+        groups = ops.duplicates(ops.find(self.workspace.path))
+        names = self.names(groups)
+        self.assertEqual(len(names), 2)
+        self.assertEqual(names[0], ['big1', 'big2'])
+        self.assertTrue(names[1] in (['link', 'small2'], ['small1', 'small2']))
+        for group in groups:
+            for p in group:
+                self.assertTrue(isinstance(p, ops.path))
+
+    def test_min_size(self):
+        groups = ops.duplicates(ops.find(self.workspace.path), min_size=0, workers=1)
+        self.assertTrue(['empty1', 'empty2'] in self.names(groups))
+        self.assertEqual(len(groups), 3)
+
+    def test_hash_file(self):
+        path = self.workspace.join('big3')
+        self.assertEqual(ops._hash_file(path, size=64 * 1024), ops._hash_file(self.workspace.join('big1'), size=64 * 1024))
+        self.assertNotEqual(ops._hash_file(path), ops._hash_file(self.workspace.join('big1')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,12 +5,142 @@ import helper
 import datetime
 import copy
 import os
+import threading
 import time
 import unittest
 
 import ops
 
 
+class DirEntryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = helper.Workspace()
+        self.dir_path = self.workspace.join('dir')
+        self.file_path = self.workspace.join('file')
+        self.link_path = self.workspace.join('link')
+        os.makedirs(self.dir_path)
+        with open(self.file_path, 'w') as f:
+            f.write('hello world')
+        os.symlink(self.dir_path, self.link_path)
+
+    def tearDown(self):
+        self.workspace.destroy()
+
+    def entry(self, name):
+        return ops._DirEntry(self.workspace.path, name)
+
+    def test_file(self):
+        entry = self.entry('file')
+        self.assertEqual(entry.path, self.file_path)
+        self.assertTrue(entry.is_file())
+        self.assertFalse(entry.is_dir())
+        self.assertFalse(entry.is_symlink())
+        self.assertEqual(entry.stat().st_size, 11)
+
+    def test_symlink(self):
+        entry = self.entry('link')
+        self.assertTrue(entry.is_dir())
+        self.assertFalse(entry.is_dir(follow_symlinks=False))
+        self.assertTrue(entry.is_symlink())
+        self.assertEqual(entry.stat().st_ino, os.stat(self.dir_path).st_ino)
+
+    def test_missing(self):
+        entry = self.entry('missing')
+        self.assertFalse(entry.is_file())
+        self.assertFalse(entry.is_dir())
+
+
+class WalkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = helper.Workspace()
+        for n1 in range(0, 3):
+            for n2 in range(0, 3):
+                p = self.workspace.join('dir%s' % n1, 'dir%s' % n2)
+                os.makedirs(p)
+                with open(os.path.join(p, 'file'), 'w') as f:
+                    f.write('hello world')
+        os.symlink(self.workspace.join('dir0'), self.workspace.join('link'))
+
+    def tearDown(self):
+        self.workspace.destroy()
+
+    def walk(self, top_down):
+        result = []
+        for root, entry, depth, dirs, files in ops._walk(self.workspace.path, top_down=top_down):
+            if entry is not None:
+                self.assertEqual(entry.path, root)
+            self.assertEqual(depth, root.count(os.sep) - self.workspace.path.count(os.sep))
+            result.append((
+                root,
+                sorted(e.name for e in dirs),
+                sorted(e.name for e in files),
+            ))
+        return result
+
+    def os_walk(self, top_down):
+        return [(r, sorted(d), sorted(f)) for r, d, f in os.walk(self.workspace.path, topdown=top_down)]
+
+    def test_top_down(self):
+        result = self.walk(True)
+        self.assertEqual(result[0][0], self.workspace.path)
+        self.assertEqual(sorted(result), sorted(self.os_walk(True)))
+
+    def test_bottom_up(self):
+        result = self.walk(False)
+        self.assertEqual(result[-1][0], self.workspace.path)
+        self.assertEqual(sorted(result), sorted(self.os_walk(False)))
+
+    def test_missing(self):
+        self.assertEqual(list(ops._walk(self.workspace.join('missing'))), [])
+
+    def test_parallel(self):
+        for top_down in (True, False):
+            result = []
+            for root, entry, depth, dirs, files in ops._walk_parallel(self.workspace.path, top_down=top_down, workers=4):
+                result.append((
+                    root,
+                    sorted(e.name for e in dirs),
+                    sorted(e.name for e in files),
+                ))
+            self.assertEqual(sorted(result), sorted(self.os_walk(top_down)))
+            roots = [r[0] for r in result]
+            for i, root in enumerate(roots):
+                parent = os.path.dirname(root)
+                if parent in roots:
+                    if top_down:
+                        self.assertTrue(roots.index(parent) < i)
+                    else:
+                        self.assertTrue(roots.index(parent) > i)
+
+    def test_prune(self):
+        prune = lambda e, depth: e.name == 'dir1'
+        descend = lambda e, depth: depth < 2
+        for walk in (ops._walk, ops._walk_parallel):
+            roots = []
+            for root, entry, depth, dirs, files in walk(self.workspace.path, prune=prune, descend=descend):
+                self.assertFalse('dir1' in [e.name for e in dirs])
+                self.assertTrue(depth < 2)
+                roots.append(root)
+            self.assertEqual(sorted(roots), [
+                self.workspace.path,
+                self.workspace.join('dir0'),
+                self.workspace.join('dir2'),
+            ])
+
+    def test_parallel_missing(self):
+        self.assertEqual(list(ops._walk_parallel(self.workspace.join('missing'))), [])
+
+    def test_parallel_error(self):
+        def prune(e, depth):
+            raise TypeError('prune')
+        with self.assertRaises(TypeError):
+            list(ops._walk_parallel(self.workspace.path, prune=prune, workers=4))
+        with self.assertRaises(TypeError):
+            list(ops.find(self.workspace.path, workers=4).prune(mtime__gt='x'))
+
+
 class FindRuleTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -70,6 +200,116 @@ class FindNameRuleTestCase(unittest.TestCase):
     def test_no_match(self):
         self.assertFalse(self.rule(ops.path('world.py')))
 
+    def test_list(self):
+        rule = ops._FindNameRule(['*.py', 'test_*'])
+        self.assertTrue(rule(ops.path('test_find.py')))
+        self.assertTrue(rule(ops.path('find.py')))
+        self.assertTrue(rule(ops.path('test_find.pyc')))
+        self.assertFalse(rule(ops.path('find.pyc')))
+
+    def test_patterns(self):
+        rule = ops._FindNameRule(patterns=['*.py', 'test_*'])
+        self.assertTrue(rule(ops.path('test_find.py')))
+        self.assertFalse(rule(ops.path('find.py')))
+        self.assertFalse(rule(ops.path('test_find.pyc')))
+
+    def test_patterns_exclude(self):
+        rule = ops._FindNameRule(patterns=['*.py', 'test_*'], exclude=True)
+        self.assertFalse(rule(ops.path('test_find.py')))
+        self.assertFalse(rule(ops.path('find.py')))
+        self.assertFalse(rule(ops.path('test_find.pyc')))
+        self.assertTrue(rule(ops.path('find.pyc')))
+
+
+class FindStatRuleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        s = ops.stat('/tmp')
+        s._data = [
+            0o100640,  # st_mode
+            0,  # st_ino
+            0,  # st_dev
+            2,  # st_nlink
+            1000,  # st_uid
+            100,  # st_gid
+            4096,  # st_size
+            0,  # st_atime
+            0,  # st_mtime
+            0,  # st_ctime
+        ]
+        self.path = ops.path('/tmp', stat=s)
+
+    def rule(self, field, op, value):
+        return ops._FindStatRule(field, op, value)(self.path)
+
+    def test_size(self):
+        self.assertTrue(self.rule('size', '', 4096))
+        self.assertFalse(self.rule('size', 'exact', 4095))
+        self.assertTrue(self.rule('size', 'lt', 4097))
+        self.assertFalse(self.rule('size', 'lt', 4096))
+        self.assertTrue(self.rule('size', 'lte', 4096))
+        self.assertTrue(self.rule('size', 'gt', 4095))
+        self.assertFalse(self.rule('size', 'gt', 4096))
+        self.assertTrue(self.rule('size', 'gte', 4096))
+
+    def test_ids(self):
+        self.assertTrue(self.rule('uid', '', 1000))
+        self.assertFalse(self.rule('uid', '', 0))
+        self.assertTrue(self.rule('gid', '', 100))
+        self.assertTrue(self.rule('nlink', 'gt', 1))
+
+    def test_mode(self):
+        self.assertTrue(ops._FindModeRule('', 0o640)(self.path))
+        self.assertTrue(ops._FindModeRule('', ops.mode(0o640))(self.path))
+        self.assertFalse(ops._FindModeRule('exact', 0o644)(self.path))
+        self.assertTrue(ops._FindModeRule('all', 0o600)(self.path))
+        self.assertFalse(ops._FindModeRule('all', 0o700)(self.path))
+        self.assertTrue(ops._FindModeRule('any', 0o111 | 0o040)(self.path))
+        self.assertFalse(ops._FindModeRule('any', 0o007)(self.path))
+
+
+class CompileRulesTestCase(unittest.TestCase):
+
+    def test_order(self):
+        rules = ops._compile_rules([
+            ops._FindTimeRule('mtime', 'year', 2010),
+            ops._FindFileRule(True),
+            ops._FindNameRule('*.py'),
+        ])
+        self.assertEqual(len(rules), 3)
+        self.assertTrue(isinstance(rules[0], ops._FindNameRule))
+        self.assertTrue(isinstance(rules[1], ops._FindFileRule))
+        self.assertTrue(isinstance(rules[2], ops._FindTimeRule))
+
+    def test_merge_names(self):
+        rules = ops._compile_rules([
+            ops._FindNameRule('*.py'),
+            ops._FindDirectoryRule(False),
+            ops._FindNameRule('test_*'),
+            ops._FindNameRule('*.pyc', exclude=True),
+            ops._FindNameRule('*.pyo', exclude=True),
+        ])
+        self.assertEqual(len(rules), 3)
+        self.assertEqual(rules[0].patterns, ['*.py', 'test_*'])
+        self.assertFalse(rules[0].exclude)
+        self.assertEqual(rules[1].patterns, ['*.pyc', '*.pyo'])
+        self.assertTrue(rules[1].exclude)
+        self.assertTrue(isinstance(rules[2], ops._FindDirectoryRule))
+
+    def test_skip_stat(self):
+        calls = []
+
+        class Rule(ops._FindRule):
+            def __call__(self, path):
+                calls.append(path)
+                return True
+
+        find = ops.find(os.path.dirname(os.path.realpath(__file__)))
+        find.rules.append(Rule())
+        find.filter(name='test_find.py')
+        self.assertEqual(len(list(find)), 1)
+        self.assertEqual(len(calls), 1)
+
 
 class FindTimeRuleTestCase(unittest.TestCase):
 
@@ -189,6 +429,102 @@ class FindTestCase(unittest.TestCase):
         self.assertTrue(isinstance(find.rules[1], ops._FindTimeRule))
         self.assertTrue(isinstance(find.rules[2], ops._FindTimeRule))
 
+    def test_add_rule_stat(self):
+        find = ops.find('.')
+        find._add_rule({'size__gt': 10})
+        find._add_rule({'nlink': 1})
+        find._add_rule({'user': os.geteuid()})
+        find._add_rule({'group': ops.group()})
+        self.assertEqual([r.field for r in find.rules], ['size', 'nlink', 'uid', 'gid'])
+        self.assertEqual(find.rules[0].op, 'gt')
+        self.assertEqual(find.rules[3].value, os.getegid())
+        find._add_rule({'user': ops.user().name})
+        self.assertEqual(find.rules[4].value, os.geteuid())
+
+    def test_add_rule_other(self):
+        find = ops.find('.')
+        find._add_rule({'mode__any': 0o111})
+        find._add_rule({'link': True})
+        find._add_rule({'empty': True})
+        self.assertTrue(isinstance(find.rules[0], ops._FindModeRule))
+        self.assertTrue(isinstance(find.rules[1], ops._FindLinkRule))
+        self.assertTrue(isinstance(find.rules[2], ops._FindEmptyRule))
+
+    def test_stat_rules(self):
+        self.setup_directory()
+        os.makedirs(self.workspace.join('empty'))
+        open(self.workspace.join('empty.txt'), 'w').close()
+        os.symlink(self.workspace.join('empty.txt'), self.workspace.join('link'))
+        os.chmod(self.workspace.join('empty.txt'), 0o600)
+
+        def find(**kwargs):
+            return sorted(ops.find(self.workspace.path, no_peek=True).filter(**kwargs))
+
+        self.assertEqual(len(find(size=11)), 9)
+        self.assertEqual(len(find(file=True, size__lt=11)), 2)
+        self.assertEqual(len(find(file=True, user=os.geteuid(), group=os.getegid())), 11)
+        self.assertEqual(len(find(file=True, user=os.geteuid() + 1)), 0)
+        self.assertEqual(find(file=True, mode=0o600, link=False), [self.workspace.join('empty.txt')])
+        self.assertEqual(find(link=True), [self.workspace.join('link')])
+        self.assertEqual(find(empty=True, link=False), [
+            self.workspace.join('empty'),
+            self.workspace.join('empty.txt'),
+        ])
+        self.assertEqual(find(user='ops-test-no-such-user'), [])
+        self.assertEqual(find(user__lt='ops-test-no-such-user'), [])
+        self.assertEqual(find(group__gt='ops-test-no-such-group'), [])
+
+    def test_stat_rules_dangling(self):
+        self.setup_directory()
+        os.symlink(self.workspace.join('missing'), self.workspace.join('dangling'))
+
+        def find(**kwargs):
+            return sorted(ops.find(self.workspace.path, no_peek=True).filter(**kwargs))
+
+        self.assertEqual(len(find(file=True, size__gt=0)), 9)
+        self.assertEqual(len(find(file=True, nlink=1)), 9)
+        self.assertEqual(len(find(file=True, mode__any=0o444)), 9)
+        self.assertEqual(len(find(file=True, user=os.geteuid())), 9)
+        self.assertEqual(find(link=True), [self.workspace.join('dangling')])
+
+    def test_execute(self):
+        self.setup_directory()
+        find = ops.find(self.workspace.path).filter(file=True)
+        results = find.execute('echo')
+        self.assertEqual(len(results), 9)
+        for result in results:
+            self.assertTrue(result)
+            self.assertTrue(result.stdout.strip().endswith(b'/file'))
+
+    def test_execute_batch(self):
+        self.setup_directory()
+        find = ops.find(self.workspace.path).filter(file=True)
+        results = find.execute('printf "%s\\n" ${path} | wc -l', batch=True)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].stdout.strip(), b'9')
+        results = find.execute('printf "%s\\n" ${path} | wc -l', batch=4, workers=2)
+        self.assertEqual([r.stdout.strip() for r in results], [b'4', b'4', b'1'])
+
+    def test_execute_argv(self):
+        self.setup_directory()
+        find = ops.find(self.workspace.path).filter(file=True)
+        results = find.execute(['printf', '%s\n'], batch=True)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(len(results[0].stdout.splitlines()), 9)
+        results = find.execute(['printf', '[%s]', '${path}'], batch=4)
+        self.assertEqual([len(r.stdout.split(b'][')) for r in results], [4, 4, 1])
+        results = find.execute(['test', '-f', '$path'])
+        self.assertEqual(len(results), 9)
+        self.assertTrue(all(results))
+
+    def test_batches(self):
+        self.setup_directory()
+        find = ops.find(self.workspace.path).filter(file=True)
+        size = ops._arg_max()
+        batches = list(find._batches('x' * (size - 3 * len(self.workspace.join('dir0', 'dir0', 'file')))))
+        self.assertEqual(len(batches), 5)
+        self.assertEqual(sum(len(b) for b in batches), 9)
+
     def test_filter(self):
         dir_path = os.path.dirname(os.path.realpath(__file__))
         count = 0
@@ -196,6 +532,13 @@ class FindTestCase(unittest.TestCase):
             count += 1
         self.assertEqual(count, 1)
 
+    def test_filter_list(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        names = [os.path.basename(p) for p in ops.find(dir_path).filter(name=['test_find.py', 'test_du.py'])]
+        self.assertEqual(sorted(names), ['test_du.py', 'test_find.py'])
+        find = ops.find(dir_path).filter(name=['test_find.py', 'test_du.py'], file=True).filter(name='*.py')
+        self.assertEqual(len(list(find)), 2)
+
     def test_exclude(self):
         dir_path = os.path.dirname(os.path.realpath(__file__))
         total_count = 0
@@ -228,5 +571,168 @@ class FindTestCase(unittest.TestCase):
         for i, v in enumerate(list1):
             self.assertEqual(list2[i], v)
 
+    def test_workers(self):
+        self.setup_directory()
+        for no_peek, top_down in ((False, False), (False, True), (True, True), (True, False)):
+            list1 = sorted(ops.find(self.workspace.path, no_peek=no_peek, top_down=top_down))
+            list2 = sorted(ops.find(self.workspace.path, no_peek=no_peek, top_down=top_down, workers=4))
+            self.assertEqual(len(list2), 22)
+            self.assertEqual(list1, list2)
+
+    def test_prune(self):
+        self.setup_directory()
+        for workers in (None, 4):
+            for no_peek, top_down in ((False, False), (False, True), (True, True), (True, False)):
+                paths = list(ops.find(self.workspace.path, no_peek=no_peek, top_down=top_down, workers=workers)
+                             .prune(name='dir1').prune(name='dir2', directory=True))
+                self.assertEqual(sorted(paths), [
+                    self.workspace.path,
+                    self.workspace.join('dir0'),
+                    self.workspace.join('dir0', 'dir0'),
+                    self.workspace.join('dir0', 'dir0', 'file'),
+                ])
+
+    def test_depth(self):
+        self.setup_directory()
+        for workers in (None, 4):
+            for no_peek, top_down in ((False, False), (False, True), (True, True), (True, False)):
+                def depth(**kwargs):
+                    return sorted(ops.find(self.workspace.path, no_peek=no_peek, top_down=top_down,
+                                           workers=workers, **kwargs))
+                self.assertEqual(depth(max_depth=0), [self.workspace.path])
+                self.assertEqual(len(depth(max_depth=1)), 4)
+                self.assertEqual(len(depth(max_depth=2)), 13)
+                self.assertEqual(len(depth(min_depth=1, max_depth=2)), 12)
+                self.assertEqual(len(depth(min_depth=3)), 9)
+                self.assertEqual(depth(min_depth=2), depth(min_depth=2, one_file_system=True))
+
+    def test_index(self):
+        self.setup_directory()
+        index = self.workspace.join('index.db')
+        root = self.workspace.join('root')
+        os.rename(self.workspace.join('dir0'), root)
+        for no_peek, top_down in ((False, False), (False, True), (True, True), (True, False)):
+            list1 = sorted(ops.find(root, no_peek=no_peek, top_down=top_down))
+            list2 = sorted(ops.find(root, no_peek=no_peek, top_down=top_down, index=index))
+            self.assertEqual(len(list1), 7)
+            self.assertEqual(list1, list2)
+
+        for p in ops.find(root, index=index).filter(file=True):
+            self.assertEqual(p.stat.size, 11)
+            self.assertEqual(p.stat.inode, os.stat(p).st_ino)
+
+        # changes are picked up unless refresh is disabled
+        with open(os.path.join(root, 'new'), 'w') as f:
+            f.write('new')
+        os.remove(os.path.join(root, 'dir1', 'file'))
+        os.rmdir(os.path.join(root, 'dir1'))
+        self.assertEqual(len(list(ops.find(root, index=index, refresh=False))), 7)
+        paths = sorted(ops.find(root, index=index))
+        self.assertEqual(paths, sorted(ops.find(root)))
+        self.assertEqual(len(paths), 6)
+        self.assertEqual(len(list(ops.find(root, index=index, refresh=False))), 6)
+
+    def test_entry_stat(self):
+        self.setup_directory()
+        for p in ops.find(self.workspace.path).filter(file=True):
+            self.assertTrue(isinstance(p, ops.path))
+            self.assertTrue(p.stat.file)
+            self.assertFalse(p.stat.directory)
+            self.assertEqual(p.stat.size, 11)
+            self.assertEqual(p.stat.inode, os.stat(p).st_ino)
+
+    def test_symlink(self):
+        self.setup_directory()
+        os.symlink(self.workspace.join('dir0'), self.workspace.join('link'))
+        paths = list(ops.find(self.workspace.path, no_peek=True))
+        self.assertEqual(len(paths), 23)
+        self.assertEqual(paths.count(self.workspace.join('dir0')), 2)
+
+
+class FindWatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = helper.Workspace()
+        os.makedirs(self.workspace.join('dir'))
+        with open(self.workspace.join('dir', 'old.txt'), 'w') as f:
+            f.write('old')
+
+    def tearDown(self):
+        self.workspace.destroy()
+
+    def later(self, func, *args):
+        timer = threading.Timer(0.1, func, args)
+        timer.start()
+        return timer
+
+    def write(self, name, content='new'):
+        path = self.workspace.join(*name.split('/'))
+        with open(path + '.tmp', 'w') as f:
+            f.write(content)
+        os.rename(path + '.tmp', path)
+
+    def check(self, **kwargs):
+        find = ops.find(self.workspace.path).filter(name='*.txt').prune(name='skip')
+        watch = find.watch(timeout=2, **kwargs)
+
+        self.later(self.write, 'dir/new.txt')
+        event, path = next(watch)
+        self.assertEqual(event, 'add')
+        self.assertEqual(path, self.workspace.join('dir', 'new.txt'))
+        self.assertEqual(path.stat.size, 3)
+
+        self.later(self.write, 'dir/new.txt', 'changed')
+        event, path = next(watch)
+        self.assertEqual(event, 'modify')
+        self.assertEqual(path.stat.size, 7)
+
+        def mkdir():
+            os.makedirs(self.workspace.join('skip'))
+            self.write('skip/skip.txt')
+            self.write('dir/ignore.log')
+            os.makedirs(self.workspace.join('sub'))
+            self.write('sub/sub.txt')
+        self.later(mkdir)
+        event, path = next(watch)
+        self.assertEqual(event, 'add')
+        self.assertEqual(path, self.workspace.join('sub', 'sub.txt'))
+
+        self.later(os.remove, self.workspace.join('dir', 'old.txt'))
+        event, path = next(watch)
+        self.assertEqual(event, 'delete')
+        self.assertEqual(path, self.workspace.join('dir', 'old.txt'))
+
+        watch.close()
+
+    def test_inotify(self):
+        self.check()
+
+    def test_poll(self):
+        self.check(poll=True, interval=0.05)
+
+    def test_inotify_high_fd(self):
+        # select() can't wait on descriptors above FD_SETSIZE (1024)
+        fds = []
+        try:
+            try:
+                while not fds or fds[-1] < 1100:
+                    fds.append(os.open(os.devnull, os.O_RDONLY))
+                inotify = ops._Inotify()
+            except OSError:
+                self.skipTest('inotify or enough file descriptors unavailable')
+            try:
+                self.assertTrue(inotify.fd > 1024)
+                self.assertEqual(inotify.read(0), [])
+            finally:
+                inotify.close()
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def test_initial(self):
+        watch = ops.find(self.workspace.path).filter(file=True).watch(initial=True, timeout=0.1)
+        self.assertEqual(list(watch), [('add', self.workspace.join('dir', 'old.txt'))])
+
+
 if __name__ == '__main__':
     unittest.main()
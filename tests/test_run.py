@@ -2,26 +2,27 @@ from __future__ import unicode_literals
 
 import helper
 
+import logging
 import os
+import time
 import unittest
 
 import ops
 
 
-class RunTestCase(unittest.TestCase):
+class RunTestMixin(object):
 
     def setUp(self):
         self.root_path = os.path.dirname(os.path.realpath(__file__))
         self.run_path = os.path.join(self.root_path, 'assets', 'run.py')
 
     def do(self, text='', code=0):
-        r = ops.run(
+        return self.run_command(
             'python ${run} ${code} ${text}',
             run=self.run_path,
             code=code,
             text=text,
         )
-        return r
 
     def text(self):
         return ('"some uuid" \' *>/ %s' % helper.uuid()).encode('utf-8')
@@ -42,19 +43,520 @@ class RunTestCase(unittest.TestCase):
 
     def test_dict(self):
         args = {'-f': self.run_path}
-        results = ops.run('test ${args}', args=args)
+        results = self.run_command('test ${args}', args=args)
         self.assertTrue(results)
         self.assertEqual(results.code, 0)
 
     def test_list(self):
         args = ['?!*', '=', '?!*']
-        results = ops.run('test ${args}', args=args)
+        results = self.run_command('test ${args}', args=args)
         self.assertTrue(results)
         self.assertEqual(results.code, 0)
 
+    def test_large(self):
+        results = self.run_command('head -c 1000000 /dev/zero; printf x')
+        self.assertEqual(len(results.stdout), 1000001)
+        self.assertTrue(results.stdout.endswith(b'x'))
+
+    def test_callback(self):
+        lines = []
+        results = self.run_command('printf "one\\ntwo\\nthree"', stdout=lines.append)
+        self.assertEqual(results.stdout, b'one\ntwo\nthree')
+        self.assertEqual(lines, [b'one\n', b'two\n', b'three'])
+
+    def test_combine(self):
+        results = self.run_command('echo out; echo err >&2', combine=True)
+        self.assertEqual(sorted(results.stdout.split()), [b'err', b'out'])
+        self.assertEqual(results.stderr, b'')
+
     def test_stdin(self):
-        results = ops.run('bash', stdin='echo -n ok')
+        results = self.run_command('bash', stdin='echo -n ok')
         self.assertEqual(results.stdout, b'ok')
 
+    def test_stdin_large(self):
+        # more input than the pipes can hold while output isn't read
+        data = b'x' * (4 * 1024 * 1024)
+        results = self.run_command('cat', stdin=data)
+        self.assertEqual(len(results.stdout), len(data))
+
+    def test_stdin_stream(self):
+        workspace = helper.Workspace()
+        try:
+            path = workspace.join('input')
+            with open(path, 'wb') as f:
+                f.write(b'one\ntwo\n' * 100000)
+            results = self.run_command('wc -l', stdin=ops.path(path))
+            self.assertEqual(results.stdout.strip(), b'200000')
+            with open(path, 'rb') as f:
+                results = self.run_command('wc -l', stdin=f)
+            self.assertEqual(results.stdout.strip(), b'200000')
+        finally:
+            workspace.destroy()
+        results = self.run_command('wc -c', stdin=(b'x' * 1000 for _ in range(10000)))
+        self.assertEqual(results.stdout.strip(), b'10000000')
+        results = self.run_command('cat', stdin=['one', u'\u2713', b'three'])
+        self.assertEqual(results.stdout, u'one\u2713three'.encode('utf-8'))
+        results = self.run_command('tr a-z A-Z', stdin=ops.run_stream('echo out; echo err >&2'))
+        self.assertEqual(results.stdout, b'OUT\n')
+
+    def test_stdin_closed(self):
+        start = time.time()
+        results = self.run_command('head -c 3', stdin=(b'x' * 65536 for _ in range(100000)))
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(results.stdout, b'xxx')
+
+    def test_argv(self):
+        results = self.run_command(['printf', '%s|', '${one}', 'x${one}', '${many}', '$$HOME'],
+                                   one='a b $c', many=['d', "'e'"])
+        self.assertTrue(results)
+        self.assertEqual(results.stdout, b"a b $c|xa b $c|d|'e'|$HOME|")
+
+    def test_timeout(self):
+        start = time.time()
+        results = self.run_command('echo partial; sleep 10; echo done', timeout=0.2)
+        self.assertTrue(time.time() - start < 5)
+        self.assertFalse(results)
+        self.assertTrue(results.timed_out)
+        self.assertEqual(results.stdout, b'partial\n')
+
+    def test_timeout_kill(self):
+        start = time.time()
+        results = self.run_command('trap "" TERM; sleep 10 & wait; sleep 10', timeout=0.2, kill_grace=0.2)
+        self.assertTrue(time.time() - start < 5)
+        self.assertTrue(results.timed_out)
+        self.assertEqual(results.code, -9)
+
+    def test_no_timeout(self):
+        results = self.run_command('echo ok', timeout=5)
+        self.assertTrue(results)
+        self.assertFalse(results.timed_out)
+
+    def test_argv_missing(self):
+        with self.assertRaises(OSError):
+            self.run_command(['does-not-exist-ops-test'])
+
+
+class RunTestCase(RunTestMixin, unittest.TestCase):
+
+    def run_command(self, *args, **kwargs):
+        return ops.run(*args, **kwargs)
+
+    def test_spill(self):
+        workspace = helper.Workspace()
+        try:
+            results = ops.run('head -c 100000 /dev/zero; printf x; echo err >&2',
+                              max_output=1000, spill_dir=workspace.path)
+            self.assertTrue(results)
+            self.assertEqual(results.stderr, b'err\n')
+            stdout = results.stdout
+            self.assertFalse(isinstance(stdout, bytes))
+            self.assertEqual(len(stdout), 100001)
+            self.assertEqual(b''.join(stdout), b'\0' * 100000 + b'x')
+            self.assertEqual(stdout.getvalue(), b''.join(stdout))
+            self.assertEqual(stdout.mmap()[-1:], b'x')
+            stdout.seek(99999)
+            self.assertEqual(stdout.read(), b'\0x')
+            stdout.close()
+        finally:
+            workspace.destroy()
+
+    def test_rusage(self):
+        metrics = []
+        results = ops.run(['python', '-c', '${code}'], metrics=metrics.append,
+                          code='import time\nt = time.time()\nwhile time.time() - t < 0.3: pass')
+        self.assertTrue(results)
+        self.assertEqual(metrics, [results])
+        self.assertTrue(0.3 <= results.duration < 5)
+        self.assertTrue(results.rusage.user + results.rusage.system >= 0.2)
+        self.assertTrue(results.rusage.max_rss > 1024 * 1024)
+
+    def test_rusage_sleep(self):
+        results = ops.run(['sleep', '0.3'])
+        self.assertTrue(results.duration >= 0.3)
+        self.assertTrue(results.rusage.user + results.rusage.system < 0.2)
+
+
+class RunCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = helper.Workspace()
+        self.store = ops.run_cache(max_size=2)
+        self.command = 'echo ${name}; od -An -tx1 -N16 /dev/urandom; echo err >&2'
+
+    def tearDown(self):
+        self.workspace.destroy()
+
+    def run_cached(self, name='one', **kwargs):
+        kwargs.setdefault('cache', True)
+        return ops.run(self.command, name=name, cache_store=self.store, **kwargs)
+
+    def test_cache(self):
+        first = self.run_cached()
+        self.assertTrue(first)
+        lines = []
+        second = self.run_cached(stderr=lines.append)
+        self.assertEqual(second.stdout, first.stdout)
+        self.assertEqual(second.stderr, b'err\n')
+        self.assertEqual(lines, [b'err\n'])
+        self.assertNotEqual(self.run_cached('two').stdout, first.stdout)
+        self.assertNotEqual(self.run_cached(cwd='/').stdout, first.stdout)
+        self.assertNotEqual(self.run_cached(env={'NAME': 'value'}).stdout, first.stdout)
+        self.assertNotEqual(self.run_cached(cache=None).stdout, first.stdout)
+
+    def test_ttl(self):
+        first = self.run_cached(cache=0.1)
+        self.assertEqual(self.run_cached(cache=0.1).stdout, first.stdout)
+        time.sleep(0.15)
+        self.assertNotEqual(self.run_cached(cache=0.1).stdout, first.stdout)
+
+    def test_lru(self):
+        one = self.run_cached('one')
+        two = self.run_cached('two')
+        self.run_cached('one')
+        self.run_cached('three')
+        self.assertEqual(self.run_cached('one').stdout, one.stdout)
+        self.assertNotEqual(self.run_cached('two').stdout, two.stdout)
+
+    def test_invalidate(self):
+        one = self.run_cached('one')
+        two = self.run_cached('two')
+        self.store.invalidate(self.command, name='one')
+        self.assertNotEqual(self.run_cached('one').stdout, one.stdout)
+        self.assertEqual(self.run_cached('two').stdout, two.stdout)
+        self.store.invalidate()
+        self.assertNotEqual(self.run_cached('two').stdout, two.stdout)
+
+    def test_failure(self):
+        first = ops.run('od -An -tx1 -N16 /dev/urandom; exit 3', cache=True, cache_store=self.store)
+        self.assertEqual(first.code, 3)
+        self.assertEqual(ops.run('od -An -tx1 -N16 /dev/urandom; exit 3', cache=True, cache_store=self.store).stdout, first.stdout)
+        first = ops.run('od -An -tx1 -N16 /dev/urandom; sleep 5', cache=True, cache_store=self.store, timeout=0.1)
+        self.assertTrue(first.timed_out)
+        self.assertNotEqual(ops.run('od -An -tx1 -N16 /dev/urandom; sleep 5', cache=True, cache_store=self.store,
+                                    timeout=0.1).stdout, first.stdout)
+
+    def test_path(self):
+        path = self.workspace.join('cache.db')
+        self.store = ops.run_cache(path=path)
+        first = self.run_cached(cache=60)
+        self.store = ops.run_cache(path=path)
+        second = self.run_cached(cache=60)
+        self.assertEqual(second.stdout, first.stdout)
+        self.assertEqual(second.code, 0)
+        self.assertEqual(second.rusage.max_rss, first.rusage.max_rss)
+        self.store.invalidate()
+        self.store = ops.run_cache(path=path)
+        self.assertNotEqual(self.run_cached(cache=60).stdout, first.stdout)
+
+
+class PipelineTestCase(unittest.TestCase):
+
+    def test_basic(self):
+        results = ops.pipeline(['printf', '${text}'], ['tr', 'a-z', 'A-Z'], 'cat; echo err >&2',
+                               text='one\ntwo\n')
+        self.assertTrue(results)
+        self.assertEqual(results.stdout, b'ONE\nTWO\n')
+        self.assertEqual(results.stderr, b'err\n')
+        self.assertEqual(results.codes, [0, 0, 0])
+        self.assertEqual(results.command, "printf 'one\ntwo\n' | tr a-z A-Z | cat; echo err >&2")
+
+    def test_stdin(self):
+        results = ops.pipeline(['sort'], ['head', '-n', '1'], stdin='b\na\n')
+        self.assertEqual(results.stdout, b'a\n')
+
+    def test_stdin_stream(self):
+        results = ops.pipeline(['sort'], ['uniq', '-c'], stdin=iter([b'b\na\n', b'b\n']))
+        self.assertEqual(results.stdout.split(), [b'1', b'a', b'2', b'b'])
+
+    def test_pipefail(self):
+        results = ops.pipeline('exit 3', ['cat'])
+        self.assertTrue(results)
+        self.assertEqual(results.codes, [3, 0])
+        results = ops.pipeline('exit 3', ['cat'], pipefail=True)
+        self.assertFalse(results)
+        self.assertEqual(results.code, 3)
+
+    def test_sigpipe(self):
+        start = time.time()
+        results = ops.pipeline(['yes'], ['head', '-n', '2'])
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(results.stdout, b'y\ny\n')
+        self.assertEqual(results.code, 0)
+
+    def test_rusage(self):
+        results = ops.pipeline(['sleep', '0.2'], ['cat'])
+        self.assertTrue(results.duration >= 0.2)
+        self.assertTrue(results.rusage.max_rss > 0)
+
+    def test_timeout(self):
+        results = ops.pipeline(['sleep', '10'], ['cat'], timeout=0.2)
+        self.assertTrue(results.timed_out)
+        self.assertFalse(results)
+
+
+class RunStreamTestCase(unittest.TestCase):
+
+    def test_chunks(self):
+        stream = ops.run_stream('head -c 200000 /dev/zero; echo err >&2; exit 3')
+        self.assertEqual(stream.code, None)
+        stdout = 0
+        stderr = b''
+        for name, chunk in stream:
+            if name == 'stdout':
+                stdout += len(chunk)
+            else:
+                stderr += chunk
+        self.assertEqual(stdout, 200000)
+        self.assertEqual(stderr, b'err\n')
+        self.assertEqual(stream.code, 3)
+        self.assertFalse(stream)
+        self.assertTrue(stream.duration > 0)
+        self.assertTrue(stream.rusage.max_rss > 0)
+
+    def test_lines(self):
+        stream = ops.run_stream('printf "one\\ntwo\\nthree"', lines=True)
+        self.assertEqual(list(stream), [('stdout', b'one\n'), ('stdout', b'two\n'), ('stdout', b'three')])
+        self.assertTrue(stream)
+
+    def test_early_exit(self):
+        stream = ops.run_stream('exec yes', lines=True)
+        iterator = iter(stream)
+        self.assertEqual(next(iterator), ('stdout', b'y\n'))
+        iterator.close()
+        self.assertEqual(stream.code, -15)
+
+    def test_early_exit_group(self):
+        stream = ops.run_stream('sleep 7 & echo $!; wait; echo done', lines=True)
+        for name, line in stream:
+            pid = int(line)
+            break
+        self.assertEqual(stream.code, -15)
+        for _ in range(50):
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                break
+            time.sleep(0.1)
+        else:
+            self.fail('sleep is still running')
+
+    def test_timeout(self):
+        stream = ops.run_stream('echo partial; sleep 10', timeout=0.2)
+        self.assertEqual(list(stream), [('stdout', b'partial\n')])
+        self.assertTrue(stream.timed_out)
+
+
+class RunManyTestCase(unittest.TestCase):
+
+    def test_ordered(self):
+        commands = ['sleep 0.%s; echo %s' % (5 - n, n) for n in range(5)]
+        results = list(ops.run_many(commands, concurrency=5))
+        self.assertEqual([r.stdout for r in results], [('%s\n' % n).encode('utf-8') for n in range(5)])
+
+    def test_completed(self):
+        commands = [('sleep ${delay}; echo ${n}', {'delay': 0.1 * (4 - n), 'n': n}) for n in range(4)]
+        results = list(ops.run_many(commands, concurrency=4, ordered=False))
+        self.assertEqual([r.stdout for r in results], [b'3\n', b'2\n', b'1\n', b'0\n'])
+
+    def test_concurrency(self):
+        start = time.time()
+        results = list(ops.run_many(['sleep 0.2'] * 6, concurrency=3))
+        self.assertEqual(len(results), 6)
+        self.assertTrue(all(results))
+        self.assertTrue(0.4 <= time.time() - start < 1.2)
+
+    def test_kwargs(self):
+        results = list(ops.run_many(['echo ${value}', ('echo ${value}', {'value': 'two'})], value='one'))
+        self.assertEqual([r.stdout for r in results], [b'one\n', b'two\n'])
+
+    def test_keep_going(self):
+        results = list(ops.run_many(['exit 1', 'exit 0', 'exit 2'], concurrency=1))
+        self.assertEqual([r.code for r in results], [1, 0, 2])
+
+    def test_fail_fast(self):
+        results = list(ops.run_many(['exec sleep 5', 'exit 3', 'echo never'], concurrency=2, fail_fast=True))
+        self.assertEqual(len(results), 2)
+        self.assertTrue(results[0].code < 0)
+        self.assertEqual(results[1].code, 3)
+
+    def test_fail_fast_group(self):
+        start = time.time()
+        results = list(ops.run_many(['sleep 0.1; false', 'sleep 5; echo late'], concurrency=2, fail_fast=True))
+        self.assertTrue(time.time() - start < 3)
+        self.assertEqual(results[0].code, 1)
+        self.assertEqual(results[1].code, -15)
+        self.assertEqual(results[1].stdout, b'')
+
+    def test_timeout(self):
+        results = list(ops.run_many(['sleep 10', 'echo ok'], timeout=0.2))
+        self.assertTrue(results[0].timed_out)
+        self.assertFalse(results[1].timed_out)
+        self.assertTrue(results[1])
+
+    def test_stdin(self):
+        commands = [('cat', {'stdin': iter([b'%d' % n] * 1000)}) for n in range(4)]
+        results = list(ops.run_many(commands, concurrency=2))
+        self.assertEqual([r.stdout for r in results], [(b'%d' % n) * 1000 for n in range(4)])
+
+    def test_closed_pipes(self):
+        results = list(ops.run_many(['exec >&- 2>&-; sleep 0.2; exit 4', 'echo ok']))
+        self.assertEqual([r.code for r in results], [4, 0])
+
+
+class SessionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.session = ops.session()
+        self.session.start()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_output(self):
+        results = self.session.run('printf ${text}; printf err >&2; exit_code() { return 3; }; exit_code',
+                                   text='no newline')
+        self.assertEqual(results.code, 3)
+        self.assertFalse(results)
+        self.assertEqual(results.stdout, b'no newline')
+        self.assertEqual(results.stderr, b'err')
+        self.assertTrue(self.session.run(['test', '-d', '/']))
+
+    def test_state(self):
+        pid = self.session.ref.pid
+        self.session.run('cd /; NAME=value')
+        results = self.session.run('echo "$PWD $NAME"')
+        self.assertEqual(results.stdout, b'/ value\n')
+        self.assertEqual(self.session.ref.pid, pid)
+
+    def test_many(self):
+        for n in range(200):
+            self.assertEqual(self.session.run('echo ${n}', n=n).stdout, ('%s\n' % n).encode('utf-8'))
+
+    def test_stdin(self):
+        self.assertEqual(self.session.run('cat').stdout, b'')
+        self.assertEqual(self.session.run('tr a-z A-Z', stdin='hello').stdout, b'HELLO')
+        self.assertEqual(self.session.run('tr a-z A-Z', stdin=iter([b'a', b'b'])).stdout, b'AB')
+
+    def test_exit(self):
+        results = self.session.run('echo bye; exit 4')
+        self.assertEqual(results.code, 4)
+        self.assertEqual(results.stdout, b'bye\n')
+        self.assertEqual(self.session.run('echo again').stdout, b'again\n')
+
+    def test_syntax_error(self):
+        start = time.time()
+        results = self.session.run("echo 'unterminated")
+        self.assertTrue(time.time() - start < 5)
+        self.assertFalse(results)
+        self.assertNotEqual(results.code, 0)
+        self.assertEqual(self.session.run('echo again').stdout, b'again\n')
+
+    def test_callback(self):
+        lines = []
+        self.session.run('printf "one\\ntwo"', stdout=lines.append)
+        self.assertEqual(lines, [b'one\n', b'two'])
+
+    def test_combine(self):
+        results = self.session.run('echo out; echo err >&2', combine=True)
+        self.assertEqual(results.stdout, b'out\nerr\n')
+        self.assertEqual(results.stderr, b'')
+
+    def test_timeout(self):
+        results = self.session.run('echo partial; sleep 10', timeout=0.2)
+        self.assertTrue(results.timed_out)
+        self.assertEqual(results.stdout, b'partial\n')
+        self.assertTrue(self.session.run('true'))
+
+    def test_context(self):
+        with ops.session(env={'NAME': 'value'}) as session:
+            self.assertEqual(session.run('echo $NAME').stdout, b'value\n')
+        self.assertEqual(session.ref, None)
+
+
+@unittest.skipIf(ops.asyncio is None, 'asyncio not available')
+class RunAsyncTestCase(RunTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(RunAsyncTestCase, self).setUp()
+        self.loop = ops.asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_async(self, *args, **kwargs):
+        kwargs['loop'] = self.loop
+        return self.loop.run_until_complete(ops.run_async(*args, **kwargs))
+
+    def run_command(self, *args, **kwargs):
+        return self.run_async(*args, **kwargs)
+
+    def test_async(self):
+        futures = [ops.run_async('sleep 0.2; echo ${n}', n=n, loop=self.loop) for n in range(20)]
+        results = self.loop.run_until_complete(ops.asyncio.gather(*futures))
+        self.assertEqual([r.stdout for r in results], [('%s\n' % n).encode('utf-8') for n in range(20)])
+
+    def test_error(self):
+        with self.assertRaises(OSError):
+            self.run_async('missing-command', shell=False)
+
+    def test_metrics(self):
+        metrics = []
+        results = self.run_async('sleep 0.2', metrics=metrics.append)
+        self.assertEqual(metrics, [results])
+        self.assertTrue(results.duration >= 0.2)
+        self.assertEqual(results.rusage, None)
+
+    def test_stdin_iterator(self):
+        results = self.run_async('cat', stdin=iter([b'one', b'two']))
+        self.assertEqual(results.stdout, b'onetwo')
+
+    def test_stdin_blocking(self):
+        def chunks():
+            for _ in range(3):
+                time.sleep(0.2)
+                yield b'x'
+        slow = ops.run_async('cat', stdin=chunks(), loop=self.loop)
+        fast = ops.run_async('echo ok', loop=self.loop)
+        results = self.loop.run_until_complete(fast)
+        self.assertEqual(results.stdout, b'ok\n')
+        self.assertFalse(slow.done())
+        self.assertEqual(self.loop.run_until_complete(slow).stdout, b'xxx')
+
+    def test_stdin_exited(self):
+        closed = []
+
+        def chunks():
+            try:
+                time.sleep(0.3)
+                while True:
+                    yield b'x'
+            finally:
+                closed.append(True)
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('concurrent.futures')
+        logger.addHandler(handler)
+        try:
+            results = self.run_async('true', stdin=chunks())
+            self.assertTrue(results)
+            self.loop.close()
+            for _ in range(50):
+                if closed:
+                    break
+                time.sleep(0.02)
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(closed, [True])
+        self.assertEqual(records, [])
+
+    def test_stdin_error(self):
+        def chunks():
+            yield b'x'
+            raise ValueError('broken input')
+        with self.assertRaises(ValueError):
+            self.run_async('cat', stdin=chunks())
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,141 @@
+from __future__ import unicode_literals
+
+import helper
+
+import os
+import unittest
+
+import ops
+
+
+class SyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = helper.Workspace()
+        self.src = self.workspace.join('src')
+        self.dst = self.workspace.join('dst')
+        for n in range(3):
+            os.makedirs(os.path.join(self.src, 'dir%s' % n))
+            self.write(os.path.join('dir%s' % n, 'file.txt'), 'hello %s' % n)
+        os.symlink('dir0', os.path.join(self.src, 'link'))
+        os.utime(os.path.join(self.src, 'dir0'), (1000000000, 1000000000))
+
+    def tearDown(self):
+        self.workspace.destroy()
+
+    def write(self, name, content, root=None, mtime=None):
+        path = os.path.join(root or self.src, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def read(self, name):
+        with open(os.path.join(self.dst, name)) as f:
+            return f.read()
+
+    def test_initial(self):
+        result = ops.sync(self.src, self.dst)
+        self.assertTrue(result)
+        self.assertEqual(sorted(result.copied), ['dir0/file.txt', 'dir1/file.txt', 'dir2/file.txt', 'link'])
+        self.assertEqual(result.unchanged, 0)
+        self.assertEqual(self.read('dir1/file.txt'), 'hello 1')
+        self.assertEqual(os.readlink(os.path.join(self.dst, 'link')), 'dir0')
+        self.assertEqual(os.stat(os.path.join(self.dst, 'dir0')).st_mtime, 1000000000)
+
+    def test_changes(self):
+        ops.sync(self.src, self.dst, workers=2)
+        self.write('dir0/file.txt', 'changed size')
+        self.write('dir1/file.txt', 'HELLO 1', mtime=1000000000)
+        self.write('dir2/new.txt', 'new')
+        result = ops.sync(self.src, self.dst)
+        self.assertEqual(sorted(result.copied), ['dir0/file.txt', 'dir1/file.txt', 'dir2/new.txt'])
+        self.assertEqual(result.unchanged, 2)
+        self.assertEqual(self.read('dir1/file.txt'), 'HELLO 1')
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dst, 'dir2'))), ['file.txt', 'new.txt'])
+        result = ops.sync(self.src, self.dst)
+        self.assertEqual(result.copied, [])
+        self.assertEqual(result.unchanged, 5)
+
+    def test_checksum(self):
+        ops.sync(self.src, self.dst)
+        st = os.stat(os.path.join(self.src, 'dir0', 'file.txt'))
+        self.write('dir0/file.txt', 'HELLO 0', mtime=st.st_mtime)
+        self.assertEqual(ops.sync(self.src, self.dst).copied, [])
+        self.assertEqual(ops.sync(self.src, self.dst, checksum=True).copied, ['dir0/file.txt'])
+        self.assertEqual(self.read('dir0/file.txt'), 'HELLO 0')
+
+    def test_delete(self):
+        os.makedirs(os.path.join(self.dst, 'extra', 'sub'))
+        self.write('extra/sub/file.txt', 'extra', root=self.dst)
+        result = ops.sync(self.src, self.dst)
+        self.assertEqual(result.deleted, [])
+        self.write('dir0/old.txt', 'old', root=self.dst)
+        result = ops.sync(self.src, self.dst, delete=True)
+        self.assertTrue(result)
+        self.assertEqual(result.deleted, ['dir0/old.txt', 'extra'])
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'extra')))
+
+    def test_type_change(self):
+        ops.sync(self.src, self.dst)
+        os.unlink(os.path.join(self.src, 'link'))
+        os.makedirs(os.path.join(self.src, 'link'))
+        os.rename(os.path.join(self.src, 'dir1', 'file.txt'), os.path.join(self.src, 'dir1', 'tmp'))
+        os.makedirs(os.path.join(self.src, 'dir1', 'file.txt'))
+        result = ops.sync(self.src, self.dst, delete=True)
+        self.assertTrue(result)
+        self.assertTrue(os.path.isdir(os.path.join(self.dst, 'link')))
+        self.assertFalse(os.path.islink(os.path.join(self.dst, 'link')))
+        self.assertTrue(os.path.isdir(os.path.join(self.dst, 'dir1', 'file.txt')))
+
+    def test_atomic(self):
+        ops.sync(self.src, self.dst)
+        self.write('dir0/file.txt', 'changed size')
+        ops.sync(self.src, self.dst)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dst, 'dir0'))), ['file.txt'])
+
+    def test_error(self):
+        result = ops.sync(self.workspace.join('missing'), self.dst)
+        self.assertFalse(result)
+        self.assertEqual(len(result.failed), 1)
+        os.mkfifo(os.path.join(self.src, 'fifo'))
+        result = ops.sync(self.src, self.dst)
+        self.assertFalse(result)
+        self.assertEqual([name for name, error in result.failed], ['fifo'])
+        self.assertEqual(len(result.copied), 4)
+
+    def test_compare_error(self):
+        ops.sync(self.src, self.dst)
+        hash_file = ops._hash_file
+
+        def broken(path, *args, **kwargs):
+            raise IOError(13, 'Permission denied', path)
+
+        ops._hash_file = broken
+        try:
+            result = ops.sync(self.src, self.dst, checksum=True)
+        finally:
+            ops._hash_file = hash_file
+        self.assertFalse(result)
+        self.assertEqual(sorted(name for name, error in result.failed),
+                         ['dir0/file.txt', 'dir1/file.txt', 'dir2/file.txt'])
+
+    def test_copy_error(self):
+        copy_data = ops._copy_data
+
+        def broken(*args, **kwargs):
+            raise ops.Error('no copy method')
+
+        ops._copy_data = broken
+        try:
+            result = ops.sync(self.src, self.dst)
+        finally:
+            ops._copy_data = copy_data
+        self.assertFalse(result)
+        self.assertEqual(sorted(name for name, error in result.failed),
+                         ['dir0/file.txt', 'dir1/file.txt', 'dir2/file.txt'])
+        self.assertEqual(result.copied, ['link'])
+
+
+if __name__ == '__main__':
+    unittest.main()